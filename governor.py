@@ -2,33 +2,58 @@
 import logging
 import os
 import sys
-import time
 import yaml
 
+from helpers.agent_check import AgentCheckServer
 from helpers.api import RestApiServer
 from helpers.etcd import Etcd
+from helpers.haproxy import HAProxyRuntime
 from helpers.postgresql import Postgresql
+from helpers.proxy import LeaderProxy
 from helpers.ha import Ha
-from helpers.utils import setup_signal_handlers, sleep
+from helpers.scheduler import Scheduler
+from helpers.utils import api_base_url, reload_requested, setup_signal_handlers, sleep
 from helpers.aws import AWSConnection
 
+if sys.hexversion >= 0x03000000:
+    from urllib.parse import urlencode
+else:
+    from urllib import urlencode
+
 
 class Governor:
 
-    def __init__(self, config):
+    def __init__(self, config, config_file=None):
         assert config["etcd"]["ttl"] > 2 * config["loop_wait"]
 
-        self.nap_time = config['loop_wait']
+        self.config_file = config_file
         self.etcd = Etcd(config['etcd'])
         self.aws = AWSConnection(config)
-        self.postgresql = Postgresql(config['postgresql'], self.aws.on_role_change)
-        self.ha = Ha(self.postgresql, self.etcd)
+        self.haproxy = HAProxyRuntime(self, config['haproxy']) if 'haproxy' in config else None
+        self.postgresql = Postgresql(config['postgresql'], self.on_role_change)
+        self.scheduler = Scheduler(config, config['etcd']['scope'] + '/' + self.postgresql.name)
+        self.ha = Ha(self.postgresql, self.etcd, config)
         host, port = config['restapi']['listen'].split(':')
         self.api = RestApiServer(self, config['restapi'])
-        self.next_run = time.time()
+        self.postgresql.api_url = api_base_url(self.api.connection_string)
+        self.agent_check = AgentCheckServer(self, config['agent_check']) if 'agent_check' in config else None
+        self.proxy = LeaderProxy(self, config['proxy']) if 'proxy' in config else None
+
+    def on_role_change(self, new_role):
+        ret = self.aws.on_role_change(new_role)
+        return (not self.haproxy or self.haproxy.on_role_change(new_role)) and ret
 
     def touch_member(self, ttl=None):
         connection_string = self.postgresql.connection_string + '?application_name=' + self.api.connection_string
+        params = sorted((name, ('true' if value else 'false') if isinstance(value, bool) else value)
+                        for name, value in self.postgresql.tags.items())
+        if self.postgresql.failover_score is not None:
+            params.append(('score', self.postgresql.failover_score))
+        if self.postgresql.parked_slots:
+            # the members stream without a slot from us meanwhile
+            params.append(('parked', ','.join(sorted(self.postgresql.parked_slots))))
+        if params:
+            connection_string += '&' + urlencode(params)
         return self.etcd.touch_member(self.postgresql.name, connection_string, ttl)
 
     def initialize(self):
@@ -48,29 +73,36 @@ class Governor:
             else:
                 # FIXME: touch_member?
                 while True:
-                    leader = self.etcd.current_leader()
-                    if leader and self.postgresql.sync_from_leader(leader):
-                        self.postgresql.write_recovery_conf(leader)
+                    cluster = self.etcd.get_cluster()
+                    if not cluster.is_unlocked() and self.postgresql.clone(cluster):
+                        self.postgresql.write_recovery_conf(*self.postgresql.upstream(cluster))
                         self.postgresql.start()
                         break
                     sleep(5)
         elif self.postgresql.is_running():
             self.postgresql.load_replication_slots()
 
+    def reload_config(self):
+        """ on SIGHUP the postgres parameters are read again from the configuration file """
+        try:
+            with open(self.config_file, 'r') as f:
+                config = yaml.load(f)
+        except (IOError, yaml.YAMLError):
+            logging.exception('failed to reload %s', self.config_file)
+            return
+        self.postgresql.reload_config(config['postgresql'])
+
     def schedule_next_run(self):
-        self.next_run += self.nap_time
-        current_time = time.time()
-        nap_time = self.next_run - current_time
-        if nap_time <= 0:
-            self.next_run = current_time
-        else:
-            sleep(nap_time)
+        leader = self.ha.cluster and self.ha.cluster.leader
+        self.scheduler.update(self.ha.stable, leader and leader.ttl)
+        self.scheduler.schedule_next_run(self.postgresql.read_postmaster_pid())
 
     def run(self):
-        self.api.start()
-        self.next_run = time.time()
+        self.scheduler.reset()
 
         while True:
+            if self.config_file and reload_requested():
+                self.reload_config()
             self.touch_member()
             logging.info(self.ha.run_cycle())
 
@@ -88,8 +120,13 @@ def main():
     with open(sys.argv[1], 'r') as f:
         config = yaml.load(f)
 
-    governor = Governor(config)
+    governor = Governor(config, sys.argv[1])
     try:
+        # the progress of the replica creation is available from the api
+        governor.api.start()
+        governor.agent_check and governor.agent_check.start()
+        governor.haproxy and governor.haproxy.start()
+        governor.proxy and governor.proxy.start()
         governor.initialize()
         governor.run()
     except KeyboardInterrupt:
@@ -0,0 +1,142 @@
+import logging
+import multiprocessing
+import os
+import psycopg2
+import select
+import sys
+import time
+
+from threading import Thread
+
+if sys.hexversion >= 0x03000000:
+    from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+else:
+    from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+READ_TIMEOUT = 0.2  # HAProxy sends the `agent-send` string right after connecting, if it is configured
+
+
+def capacity_weight(lag, max_lag, active, max_connections, load, cpus):
+    """ The share of the capacity of the replica which is still free, in percent. The scarcest resource decides.
+
+    >>> capacity_weight(0, 1000, 10, 100, 1.0, 4)
+    75
+    >>> capacity_weight(900, 1000, 10, 100, 1.0, 4)
+    10
+    >>> capacity_weight(0, 1000, 10, 100, 8.0, 4)
+    1
+    """
+    free = [1 - float(active) / max_connections if max_connections else 1.0, 1 - float(load) / cpus]
+    if max_lag:
+        free.append(1 - float(lag) / max_lag)
+    return max(1, int(round(100 * min(free))))
+
+
+class AgentCheckHandler(BaseRequestHandler):
+    """ HAProxy agent protocol: the agent answers with one line and closes the connection. HAProxy may send the
+        role the backend wants (`master` or `replica`) with `agent-send`. """
+
+    def handle(self):
+        role = None
+        if select.select([self.request], [], [], READ_TIMEOUT)[0]:
+            role = self.request.recv(64).decode('utf-8', 'replace').strip() or None
+        self.request.sendall((self.server.response(role) + '\n').encode('utf-8'))
+
+
+class AgentCheckServer(ThreadingMixIn, TCPServer, Thread):
+    """ Answers HAProxy agent checks with `up`, `down` or `drain` and the weight of a replica.
+
+        The state of postgres is refreshed every `interval` seconds by a background thread, the checks themselves
+        never wait for postgres. Replicas lagging more than `max_lag_bytes` or with a paused replay are drained,
+        the others get a weight according to their lag, the share of `max_connections` in use by active backends
+        and the load average per cpu. """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, governor, config):
+        host, port = config['listen'].split(':')
+        # the socket is bound by `start`, creating governor has no side effects
+        TCPServer.__init__(self, (host, int(port)), AgentCheckHandler, False)
+        Thread.__init__(self, target=self.serve_forever)
+        self.daemon = True
+        self.governor = governor
+        self.interval = config.get('interval', 2)
+        self.max_lag_bytes = config.get('max_lag_bytes', 16 * 1024 * 1024)
+        self.cpus = multiprocessing.cpu_count()
+        self.status = None
+        self._connection = None
+        self.refresher = Thread(target=self.refresh_forever)
+        self.refresher.daemon = True
+
+    def start(self):
+        self.server_bind()
+        self.server_activate()
+        self.refresher.start()
+        Thread.start(self)
+
+    def query(self):
+        if not self._connection or self._connection.closed:
+            self._connection = self.governor.postgresql.connect_database('postgres')
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute("""SELECT pg_is_in_recovery(),
+                                     pg_last_xlog_receive_location() - '0/0'::pg_lsn,
+                                     pg_last_xlog_replay_location() - '0/0'::pg_lsn,
+                                     pg_is_in_recovery() AND pg_is_xlog_replay_paused(),
+                                     (SELECT count(*) FROM pg_stat_activity WHERE state = 'active'),
+                                     current_setting('max_connections')::integer""")
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def refresh(self):
+        try:
+            in_recovery, received, replayed, paused, active, max_connections = self.query()
+        except psycopg2.Error:
+            self.status = None
+            self._connection and self._connection.close()
+            return
+        status = {'role': 'replica' if in_recovery else 'master', 'active': active, 'load': os.getloadavg()[0]}
+        if in_recovery:
+            # the leader writes its position to etcd on every run of its loop
+            cluster = self.governor.ha.cluster
+            leader_location = max(cluster and cluster.last_leader_operation or 0, int(received or 0))
+            status['lag'] = max(leader_location - int(replayed or 0), 0)
+            status['paused'] = paused
+            status['weight'] = capacity_weight(status['lag'], self.max_lag_bytes, active, max_connections,
+                                               status['load'], self.cpus)
+        else:
+            status['weight'] = capacity_weight(0, 0, active, max_connections, status['load'], self.cpus)
+        self.status = status
+
+    def refresh_forever(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:  # e.g. no socket for a new connection, the thread has to survive it
+                logger.exception('refreshing the state of postgres for the agent check')
+                self.status = None
+            time.sleep(self.interval)
+
+    def response(self, role=None):
+        """
+        >>> s = AgentCheckServer(None, {'listen': '127.0.0.1:0'})
+        >>> s.response()
+        'down'
+        >>> s.status = {'role': 'replica', 'lag': 0, 'paused': False, 'weight': 75}
+        >>> s.response(), s.response('replica'), s.response('master')
+        ('up 75%', 'up 75%', 'down')
+        >>> s.status['lag'] = 32 * 1024 * 1024
+        >>> s.response()
+        'drain'
+        >>> s.server_close()
+        """
+        status = self.status
+        if not status or role in ('master', 'replica') and status['role'] != role:
+            return 'down'
+        if status['role'] == 'replica' and (status['paused'] or status['lag'] > self.max_lag_bytes):
+            return 'drain'
+        return 'up {}%'.format(status['weight'])
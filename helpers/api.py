@@ -3,33 +3,179 @@ import logging
 import os
 import psycopg2
 import sys
+import time
 
-from threading import Thread
+from helpers.bootstrap import member_status
+from helpers.errors import EtcdError, SwitchoverError
+from helpers.utils import lsn_to_bytes, wakeup
+from threading import Lock, Thread
 
 if sys.hexversion >= 0x03000000:
     from http.server import BaseHTTPRequestHandler, HTTPServer
     from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
 else:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
 
 logger = logging.getLogger(__name__)
 
+MAX_WATCH_TIMEOUT = 300
+
+
+def member_statuses(members, timeout):
+    """ asks all `members` for their status at once, the ones not answering within `timeout` seconds get None """
+    statuses = {}
+
+    def fetch(member):
+        statuses[member.hostname] = member_status(member, timeout)
+
+    threads = [Thread(target=fetch, args=(m,)) for m in members if m.api_url]
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    return dict((m.hostname, statuses.get(m.hostname)) for m in members)
+
 
 class RestApiHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
-        response = self.get_postgresql_status()
+        if self.path == '/bootstrap':
+            return self.write_response(200, self.server.governor.postgresql.clone_progress.report())
+        elif self.path == '/prewarm':
+            prewarmer = self.server.governor.postgresql.prewarmer
+            snapshot = prewarmer and prewarmer.load()
+            if snapshot:
+                snapshot['progress'] = prewarmer.progress
+            return self.write_response(200 if snapshot else 404, snapshot or {})
+        elif self.path == '/cluster':
+            return self.write_response(200, self.server.cluster_status(self.get_postgresql_status))
+        elif self.path == '/slots':
+            return self.write_response(200, self.server.governor.postgresql.slots_status())
+        elif self.path == '/resync':
+            stats = self.server.governor.postgresql.resync_stats
+            return self.write_response(200 if stats else 404, stats or {})
+        elif self.path == '/archive':
+            archiver = self.server.governor.postgresql.archiver
+            return self.write_response(200 if archiver else 404, archiver.status() if archiver else {})
+
+        path, _, query = self.path.partition('?')
+        if path == '/watch':
+            return self.watch(dict(parse_qsl(query)))
+
+        response = self.server.cached_status(self.get_postgresql_status)
 
-        path = '/master' if self.path == '/' else self.path
+        path = {'/': '/master', '/replica': '/slave'}.get(path, path)
         status_code = 200 if response['running'] and 'role' in response and response['role'] in path else 503
+        if status_code == 200 and response['role'] == 'slave':
+            status_code = self.replica_status_code(response, dict(parse_qsl(query)))
+
+        self.write_response(status_code, response)
+
+    def watch(self, query):
+        """ long poll: answers as soon as the version is not `since` any more or after `timeout` seconds """
+        try:
+            since = int(query['since']) if 'since' in query else None
+            timeout = min(max(float(query.get('timeout', 30)), 0), MAX_WATCH_TIMEOUT)
+        except ValueError:
+            return self.write_response(400, {'error': 'invalid since or timeout'})
+        self.write_response(200, self.server.governor.ha.watch(since, timeout))
+
+    @staticmethod
+    def replica_status_code(response, query):
+        """ checks the freshness of a replica against `max_lag_bytes`, `max_lag_seconds` and `min_lsn` from the
+            query string, e.g. to route reads only to replicas which have replayed a write at a known position
+
+        >>> status = {'xlog': {'replayed_location': '0/3000000', 'lag_bytes': 100, 'lag_seconds': 0.5, 'paused': False}}
+        >>> RestApiHandler.replica_status_code(status, {'max_lag_bytes': '100', 'min_lsn': '0/3000000'})
+        200
+        >>> RestApiHandler.replica_status_code(status, {'max_lag_seconds': '0.1'})
+        503
+        >>> RestApiHandler.replica_status_code(status, {'min_lsn': 'foo'})
+        400
+        """
+        xlog = response['xlog']
+        try:
+            if 'max_lag_bytes' in query and xlog['lag_bytes'] > int(query['max_lag_bytes']):
+                return 503
+            if 'max_lag_seconds' in query and (xlog['paused'] or
+                                               xlog['lag_seconds'] > float(query['max_lag_seconds'])):
+                return 503
+        except ValueError:
+            return 400
+        if 'min_lsn' in query:
+            min_lsn = lsn_to_bytes(query['min_lsn'])
+            if not min_lsn and query['min_lsn'] != '0/0':
+                return 400
+            if lsn_to_bytes(xlog['replayed_location'] or '') < min_lsn:
+                return 503
+        return 200
 
+    def do_POST(self):
+        if self.path == '/switchover':
+            request = self.read_request()
+            timeout = request.get('timeout')
+            if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or
+                                        timeout <= 0):
+                return self.write_response(400, {'error': 'timeout must be a positive number'})
+            try:
+                response = self.server.governor.ha.switchover(request.get('member'), timeout)
+                status_code = 200 if response['success'] else 503
+            except SwitchoverError as e:
+                status_code, response = 412, {'error': e.value}
+        elif self.path == '/restart':
+            postgresql = self.server.governor.postgresql
+            status_code = 200 if postgresql.restart() else 503
+            response = {'pending_restart': postgresql.pending_restart}
+        elif self.path == '/archive':
+            status_code, response = self.archive(self.read_request().get('name'))
+        elif self.path == '/wakeup':
+            wakeup()
+            status_code, response = 200, {}
+        else:
+            status_code, response = 404, {}
+        self.write_response(status_code, response)
+
+    def archive(self, name):
+        archiver = self.server.governor.postgresql.archiver
+        if not archiver:
+            return 404, {}
+        try:
+            if archiver.archive(name):
+                return 200, {'archived': name}
+        except (TypeError, ValueError) as e:
+            return 400, {'error': str(e)}
+        return 500, {'error': 'failed to archive ' + name}
+
+    def read_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        except ValueError:
+            request = None
+        return request if isinstance(request, dict) else {}
+
+    def write_response(self, status_code, response):
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
         self.end_headers()
         self.wfile.write(json.dumps(response).encode('utf-8'))
 
     def get_postgresql_status(self):
+        status = self.query_postgresql_status()
+        if self.server.governor.postgresql.failover_rank:
+            # how the failover score was computed, see `Postgresql.update_failover_score`
+            status['failover_rank'] = self.server.governor.postgresql.failover_rank
+        rate_limiter = self.server.governor.etcd.rate_limiter
+        if rate_limiter:
+            status['etcd_rate_limit'] = rate_limiter.stats()
+        return status
+
+    def query_postgresql_status(self):
         try:
             row = self.server.query("""SELECT to_char(pg_postmaster_start_time(), 'YYYY-MM-DD HH24:MI:SS.MS TZ'),
                                               pg_is_in_recovery(),
@@ -38,15 +184,30 @@ class RestApiHandler(BaseHTTPRequestHandler):
                                                    ELSE pg_current_xlog_location() END,
                                               pg_last_xlog_receive_location(),
                                               pg_last_xlog_replay_location(),
-                                              pg_is_in_recovery() AND pg_is_xlog_replay_paused()""")[0]
+                                              pg_is_in_recovery() AND pg_is_xlog_replay_paused(),
+                                              (SELECT count(*) FROM pg_stat_replication WHERE state = 'backup'),
+                                              pg_last_xlog_receive_location() - '0/0'::pg_lsn,
+                                              pg_last_xlog_replay_location() - '0/0'::pg_lsn,
+                                              CASE WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location()
+                                                   THEN 0
+                                                   ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+                                               END""")[0]
+            # the leader writes its position to etcd on every run of its loop
+            cluster = self.server.governor.ha.cluster
+            leader_location = max(cluster and cluster.last_leader_operation or 0, int(row[7] or 0))
             return {
                 'running': True,
                 'postmaster_start_time': row[0],
                 'role': 'slave' if row[1] else 'master',
+                'backups': row[6],
+                'load': os.getloadavg()[0],
+                'pending_restart': self.server.governor.postgresql.pending_restart,
                 'xlog': ({
                     'received_location': row[3],
                     'replayed_location': row[4],
-                    'paused': row[5]} if row[1] else {
+                    'paused': row[5],
+                    'lag_bytes': max(leader_location - int(row[8] or 0), 0),
+                    'lag_seconds': float(row[9] or 0)} if row[1] else {
                     'location': row[2]
                 })
             }
@@ -57,6 +218,8 @@ class RestApiHandler(BaseHTTPRequestHandler):
 
 class RestApiServer(ThreadingMixIn, HTTPServer, Thread):
 
+    daemon_threads = True  # long polls on /watch must not delay the shutdown
+
     def __init__(self, governor, config):
         connect_address = (config.get('connect_address', None) or config['listen']).format(**os.environ)
         self.connection_string = 'http://{}/governor'.format(connect_address)
@@ -65,6 +228,63 @@ class RestApiServer(ThreadingMixIn, HTTPServer, Thread):
         Thread.__init__(self, target=self.serve_forever)
         self.governor = governor
         self.daemon = True
+        self.status_cache_ttl = config.get('status_cache_ttl', 1)
+        self.status_lock = Lock()
+        self.status_cache = (0, None)
+        self.cluster_cache_ttl = config.get('cluster_cache_ttl', 5)
+        self.cluster_timeout = config.get('cluster_timeout', 1)
+        self.cluster_lock = Lock()
+        self.cluster_cache = (0, None)
+
+    def cached_status(self, get_status):
+        """ health checks of load balancers and applications may come in at a high rate, postgres is queried at
+            most once per `status_cache_ttl` seconds """
+        with self.status_lock:
+            now = time.time()
+            if self.status_cache[0] <= now:
+                self.status_cache = (now + self.status_cache_ttl, get_status())
+            return self.status_cache[1]
+
+    def cluster_status(self, get_status):
+        """ the status of the whole cluster, one request fans out to all members at most once per
+            `cluster_cache_ttl` seconds; requests coming in meanwhile wait for it and share the result """
+        with self.cluster_lock:
+            if self.cluster_cache[0] <= time.time():
+                response = self.get_cluster_status(get_status)
+                self.cluster_cache = (time.time() + self.cluster_cache_ttl, response)
+            return self.cluster_cache[1]
+
+    def get_cluster_status(self, get_status):
+        governor = self.governor
+        try:
+            cluster = governor.etcd.get_cluster()
+            etcd_reachable = True
+        except EtcdError:
+            cluster = governor.ha.cluster  # as seen by the last run of the HA loop
+            etcd_reachable = False
+        response = {'etcd_reachable': etcd_reachable, 'created': round(time.time(), 3), 'members': []}
+        if not cluster:
+            return response
+
+        name = governor.postgresql.name
+        statuses = member_statuses([m for m in cluster.members if m.hostname != name], self.cluster_timeout)
+        statuses[name] = self.cached_status(get_status)
+        leader = cluster.leader and cluster.leader.hostname
+        response.update(initialized=cluster.initialize, leader=leader, leader_ttl=cluster.leader and cluster.leader.ttl,
+                        optime=cluster.last_leader_operation, sync_standby=cluster.sync_standby())
+        for member in sorted(cluster.members, key=lambda m: m.hostname):
+            conn_url = member.conn_url and urlparse(member.conn_url)  # without the credentials
+            response['members'].append({
+                'name': member.hostname,
+                'host': conn_url and '{}:{}'.format(conn_url.hostname, conn_url.port or 5432),
+                'api_url': member.api_url,
+                'ttl': member.ttl,
+                'tags': member.tags,
+                'score': member.score,
+                'leader': member.hostname == leader,
+                'status': statuses.get(member.hostname)
+            })
+        return response
 
     def query(self, sql, *params):
         cursor = self.governor.postgresql.connection().cursor()
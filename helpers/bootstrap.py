@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import re
+import requests
+import subprocess
+import time
+import zlib
+
+from helpers.utils import api_base_url, lsn_to_bytes, sleep
+from requests.exceptions import RequestException
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_RE = re.compile(r'(\d+)/(\d+) kB')
+PROGRESS_INTERVAL = 2
+# bytes per second assumed until something was observed on this node
+DEFAULT_RATES = {'basebackup': 50 * 1048576, 's3_fetch': 50 * 1048576, 'wal_replay': 16 * 1048576}
+
+
+def member_status(member, timeout=2):
+    """ returns the status reported by the REST API of the member """
+    try:
+        return requests.get(api_base_url(member.api_url) + '/slave', timeout=timeout).json()
+    except (RequestException, ValueError):
+        logger.warning('could not get the status of %s', member.hostname)
+
+
+def clone_sources(cluster, name, max_lag):
+    """ Returns members a new replica could be cloned from, the best one first and the leader as the last resort.
+
+        Healthy replicas not lagging more than `max_lag` bytes are ordered by the number of base backups they are
+        already serving, by their lag in whole megabytes and by their load average. Ties are broken by a hash of
+        both names, so that new nodes started at the same time spread over different sources. """
+    leader = cluster.leader
+    candidates = []
+    for member in cluster.members:
+        if member.hostname in (name, leader and leader.hostname) or not member.api_url or not member.conn_url:
+            continue
+        status = member_status(member)
+        if not isinstance(status, dict) or not status.get('running') or status.get('role') != 'slave':
+            continue
+        xlog = status.get('xlog', {})
+        lag = max((cluster.last_leader_operation or 0) - lsn_to_bytes(xlog.get('replayed_location') or ''), 0)
+        if xlog.get('paused') or lag > max_lag:
+            continue
+        tiebreak = zlib.crc32((name + member.hostname).encode('utf-8')) & 0xffffffff
+        candidates.append(((status.get('backups', 0), lag // 1048576, round(status.get('load', 0)), tiebreak), member))
+    candidates.sort(key=lambda c: c[0])
+    return [m for _, m in candidates] + ([leader] if leader and leader.conn_url else [])
+
+
+def parse_progress(line):
+    """ returns (done, total) bytes from a pg_basebackup --progress line
+
+    >>> parse_progress('20480/5030576 kB (0%), 0/1 tablespace (data/postgresql1/backup_label)')
+    (20971520, 5151309824)
+    >>> parse_progress('pg_basebackup: base backup completed')
+    """
+    match = PROGRESS_RE.search(line)
+    if match:
+        return int(match.group(1)) * 1024, int(match.group(2)) * 1024
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:  # removed while we were looking
+                pass
+    return size
+
+
+class CloneProgress:
+    """ State of the replica creation, reported by GET /bootstrap """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.status = {'state': 'idle'}
+
+    def start(self, method, source, attempt):
+        with self.lock:
+            self.status = {'state': 'running', 'method': method, 'source': source, 'attempt': attempt,
+                           'started': time.time(), 'bytes_done': 0, 'bytes_total': None,
+                           'throughput': None, 'eta': None}
+
+    def update(self, done, total=None):
+        """
+        >>> p = CloneProgress()
+        >>> p.start('pg_basebackup', '127.0.0.1', 1)
+        >>> p.status['started'] -= 10
+        >>> p.update(1000, 3000)
+        >>> p.report()['throughput'], p.report()['eta']
+        (100, 20)
+        """
+        with self.lock:
+            elapsed = time.time() - self.status['started']
+            throughput = done / elapsed if elapsed > 0 else None
+            self.status.update(bytes_done=done, bytes_total=total or self.status['bytes_total'],
+                               throughput=throughput)
+            total = self.status['bytes_total']
+            self.status['eta'] = max(total - done, 0) / throughput if total and throughput else None
+
+    def finish(self, success):
+        with self.lock:
+            self.status.update(state='done' if success else 'failed',
+                               duration=time.time() - self.status['started'], eta=None)
+
+    def report(self):
+        with self.lock:
+            ret = self.status.copy()
+        for name in ('throughput', 'eta', 'started', 'duration'):
+            if ret.get(name) is not None:
+                ret[name] = int(round(ret[name]))
+        return ret
+
+
+def run_basebackup(cmd, env, progress):
+    """ runs pg_basebackup with --progress and feeds its output into `progress`, returns the exit code """
+    try:
+        proc = subprocess.Popen(cmd, env=env, stderr=subprocess.PIPE, bufsize=0)
+    except OSError:
+        logger.exception('could not run pg_basebackup')
+        return 1
+
+    # progress lines are terminated by \r when stderr is a terminal, don't rely on line buffering
+    buf = b''
+    while True:
+        chunk = os.read(proc.stderr.fileno(), 4096)
+        lines = re.split(b'[\r\n]', buf + chunk)
+        # keep the incomplete last line until we get the rest of it
+        buf = lines.pop() if chunk else b''
+        for line in lines:
+            line = line.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            done_total = parse_progress(line)
+            if done_total:
+                progress.update(*done_total)
+            else:
+                logger.info(line)
+        if not chunk:
+            break
+    proc.stderr.close()
+    return proc.wait()
+
+
+def run_with_progress(cmd, path, total, progress):
+    """ runs the shell command, the progress is the size of `path` compared to the expected `total` size """
+    proc = subprocess.Popen(cmd, shell=True)
+    while proc.poll() is None:
+        progress.update(directory_size(path), total)
+        sleep(PROGRESS_INTERVAL)
+    return proc.returncode
+
+
+class CloneCostModel:
+    """ Throughputs observed while creating replicas on this node, kept in `path` across restarts.
+
+        Every new observation is mixed into the previous value with the given `weight`, so a single slow run
+        doesn't flip the decision between restoring from S3 and running pg_basebackup.
+
+    >>> m = CloneCostModel(None)
+    >>> m.estimate_basebackup(100 * 1048576)
+    2.0
+    >>> m.observe('basebackup', 100 * 1048576, 1)
+    >>> m.estimate_basebackup(100 * 1048576)
+    1.0
+    >>> m.observe('basebackup', 100 * 1048576, 2)
+    >>> m.estimate_basebackup(100 * 1048576)
+    1.33
+    >>> m.estimate_s3(100 * 1048576, 16 * 1048576)
+    3.0
+    """
+
+    def __init__(self, path, weight=0.5):
+        self.path = path
+        self.weight = weight
+        self.rates = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                rates = json.load(f)
+            return dict((name, float(rates[name])) for name in DEFAULT_RATES if rates.get(name, 0) > 0)
+        except (IOError, OSError, TypeError, ValueError, AttributeError):
+            return {}
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.rates, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            logger.exception('could not save clone statistics to %s', self.path)
+
+    def rate(self, name):
+        return self.rates.get(name, DEFAULT_RATES[name])
+
+    def observe(self, name, size, duration):
+        if not size or not duration or duration <= 0:
+            return
+        rate = size / float(duration)
+        if name in self.rates:
+            rate = self.rates[name] * (1 - self.weight) + rate * self.weight
+        self.rates[name] = rate
+        logger.info('%s throughput is now %s bytes per second', name, int(rate))
+        self.save()
+
+    def estimate_basebackup(self, size):
+        return round(size / self.rate('basebackup'), 2)
+
+    def estimate_s3(self, backup_size, wal_size):
+        return round(backup_size / self.rate('s3_fetch') + wal_size / self.rate('wal_replay'), 2)
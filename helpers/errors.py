@@ -1,4 +1,4 @@
-class EtcdError(Exception):
+class GovernorError(Exception):
 
     def __init__(self, value):
         self.value = value
@@ -7,5 +7,13 @@ class EtcdError(Exception):
         return repr(self.value)
 
 
+class EtcdError(GovernorError):
+    pass
+
+
 class CurrentLeaderError(EtcdError):
     pass
+
+
+class SwitchoverError(GovernorError):
+    pass
@@ -1,17 +1,29 @@
 import logging
+import time
 
 from helpers.errors import EtcdError
+from helpers.switchover import Switchover
+from helpers.utils import wakeup
 from psycopg2 import InterfaceError, OperationalError
+from threading import Condition, Lock
 
 logger = logging.getLogger(__name__)
 
 
 class Ha:
 
-    def __init__(self, state_handler, etcd):
+    def __init__(self, state_handler, etcd, config=None):
         self.state_handler = state_handler
         self.etcd = etcd
         self.cluster = None
+        self.stable = False  # the last cycle didn't change anything
+        # how many times the lock owner tries to start crashed postgres before handing the lock over
+        self.master_restart_attempts = (config or {}).get('master_restart_attempts', 1)
+        self.failed_starts = 0
+        self.cycle_lock = Lock()  # serializes the HA loop with operations requested through the API
+        self.version = 0  # bumped whenever the role of this node or the leader of the cluster changes
+        self.topology = (None, None)
+        self.topology_changed = Condition()
 
     def load_cluster_from_etcd(self):
         self.cluster = self.etcd.get_cluster()
@@ -22,6 +34,10 @@ class Ha:
     def update_lock(self):
         return self.etcd.update_leader(self.state_handler)
 
+    def release_lock(self):
+        self.failed_starts = 0
+        return self.etcd.delete_leader(self.state_handler.name)
+
     def has_lock(self):
         lock_owner = self.cluster.leader and self.cluster.leader.hostname
         logger.info('Lock owner: %s; I am %s', lock_owner, self.state_handler.name)
@@ -31,15 +47,94 @@ class Ha:
         return self.state_handler.demote(self.cluster.leader)
 
     def follow_the_leader(self):
-        return self.state_handler.follow_the_leader(self.cluster.leader)
+        return self.state_handler.follow_the_leader(*self.state_handler.upstream(self.cluster))
+
+    def update_synchronous_standby(self):
+        """ picks the synchronous standbys from the healthy replicas and records them in etcd """
+        if not self.state_handler.synchronous_mode:
+            if self.cluster.sync:
+                self.etcd.delete_sync_state()
+            return
+        name = self.state_handler.name
+        sync_standby = self.state_handler.pick_synchronous_standby(self.cluster)
+        recorded = self.cluster.sync_standby() if self.cluster.sync.get('leader') == name else []
+        # etcd must always name every standby which may have acknowledged a commit: new standbys are recorded
+        # before postgres waits for them, the ones removed only after postgres stopped waiting for them
+        added = [n for n in sync_standby if n not in recorded]
+        if added:
+            recorded = recorded + added
+            if not self.etcd.set_sync_state(name, recorded):
+                logger.warning('could not record the synchronous standbys %s', ', '.join(added))
+                return
+        self.state_handler.set_synchronous_standby(sync_standby)
+        if recorded != sync_standby or self.cluster.sync.get('leader') != name:
+            self.etcd.set_sync_state(name, sync_standby)
+
+    def switchover(self, member=None, timeout=None):
+        with self.cycle_lock:
+            try:
+                return Switchover(self, member, timeout).run()
+            finally:
+                self.update_topology()
+                wakeup()  # let the loop pick up the new state immediately
 
     def run_cycle(self):
+        with self.cycle_lock:
+            try:
+                return self._run_cycle()
+            finally:
+                self.update_topology()
+
+    def update_topology(self):
+        """ bumps `version` and wakes up the watchers when the role of this node or the leader changed """
+        role = self.state_handler.role
+        # the cluster is not read again after we took the lock
+        leader = self.state_handler.name if role == 'master' else \
+            self.cluster and self.cluster.leader and self.cluster.leader.hostname
+        with self.topology_changed:
+            if (role, leader) != self.topology:
+                self.topology = (role, leader)
+                self.version += 1
+                self.topology_changed.notify_all()
+
+    def watch(self, since=None, timeout=0):
+        """ waits up to `timeout` seconds while `version` is still `since`. Any other version returns at once,
+            also an older or newer one the watcher got before governor was restarted """
+        deadline = time.time() + timeout
+        with self.topology_changed:
+            while self.version == since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.topology_changed.wait(remaining)
+            return {'version': self.version, 'role': self.topology[0], 'leader': self.topology[1]}
+
+    def _run_cycle(self):
+        self.stable = False
         try:
             self.load_cluster_from_etcd()
             if not self.state_handler.is_healthy():
                 has_lock = self.has_lock()
-                self.state_handler.write_recovery_conf(None if has_lock else self.cluster.leader)
-                self.state_handler.start()
+                if has_lock and self.failed_starts >= self.master_restart_attempts:
+                    # don't keep replicas waiting for the ttl to expire
+                    self.release_lock()
+                    self.state_handler.write_recovery_conf(None)
+                    self.state_handler.start()
+                    return 'released session lock and started as a secondary because postgresql was not running'
+
+                if not has_lock and not self.state_handler.rejoin(self.cluster.leader):
+                    return 'postgresql was not running and could not rejoin the leader'
+                if has_lock:
+                    self.state_handler.write_recovery_conf(None)
+                else:
+                    self.state_handler.write_recovery_conf(*self.state_handler.upstream(self.cluster))
+                if not self.state_handler.start() and has_lock:
+                    self.failed_starts += 1
+                    if self.failed_starts >= self.master_restart_attempts:
+                        self.release_lock()
+                        return 'released session lock because postgresql failed to start'
+                    return 'failed to start postgresql while holding the session lock'
+                self.failed_starts = 0
                 if not has_lock:
                     return 'started as a secondary'
                 logging.info('started as readonly because i had the session lock')
@@ -72,6 +167,10 @@ class Ha:
                 if self.has_lock() and self.update_lock():
                     try:
                         if self.state_handler.is_leader() or self.state_handler.is_promoted:
+                            self.stable = True
+                            self.update_synchronous_standby()
+                            self.state_handler.update_prewarm_snapshot()
+                            self.state_handler.cleanup_archive()
                             return 'no action.  i am the leader with the lock'
                         self.state_handler.promote()
                         return 'promoted self to leader because i had the session lock'
@@ -85,6 +184,15 @@ class Ha:
                         return 'demoting self because i do not have the lock and i was a leader'
                     else:
                         self.follow_the_leader()
+                        # cascading replicas stream from us
+                        self.state_handler.create_replication_slots(self.cluster)
+                        self.state_handler.track_catchup()
+                        self.state_handler.update_failover_score(self.cluster)
+                        self.state_handler.update_prewarm_snapshot(self.cluster.leader)
+                        if self.state_handler.is_stale(self.cluster):
+                            self.state_handler.resync_from_leader(self.cluster.leader)
+                            return 'resynchronized stale secondary from the leader'
+                        self.stable = True
                         return 'no action.  i am a secondary and i am following a leader'
         except EtcdError:
             logger.error('Error communicating with Etcd')
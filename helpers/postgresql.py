@@ -1,11 +1,21 @@
 import logging
 import os
 import psycopg2
+import re
 import shutil
 import subprocess
 import sys
-
-from helpers.utils import sleep
+import time
+
+from helpers.bootstrap import CloneCostModel, CloneProgress, clone_sources, run_basebackup, run_with_progress
+from helpers import wal_archive, wal_restore
+from helpers.prewarm import Prewarmer
+from helpers.resync import Resync
+from helpers.utils import lsn_to_bytes, segment_to_bytes, sleep
+from helpers.wal_index import WalIndex
+from helpers.wale import BackupCatalog
+from psycopg2.extras import PhysicalReplicationConnection
+from threading import Thread
 
 if sys.hexversion >= 0x03000000:
     from urllib.parse import urlparse
@@ -14,6 +24,65 @@ else:
 
 logger = logging.getLogger(__name__)
 
+PARAMETERS_FILE = 'postgresql.governor.conf'
+SETTING_RE = re.compile(r'^\s*(-?[0-9.]+)\s*([a-zA-Z]*)\s*$')
+UNIT_RE = re.compile(r'^([0-9]*)([a-zA-Z]+)$')
+UNITS = {'kB': 1, 'MB': 1024, 'GB': 1024 ** 2, 'TB': 1024 ** 3,
+         'ms': 1, 's': 1000, 'min': 60000, 'h': 3600000, 'd': 86400000}
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+BOOL_VALUES = {'on': 'on', 'true': 'on', 'yes': 'on', '1': 'on', 'off': 'off', 'false': 'off', 'no': 'off', '0': 'off'}
+
+
+def failover_score(priority, version, warmth, lag):
+    """ Ranks the candidates for a failover, the higher the better. The priority counts most, then the minor version
+        of postgres and at last how warm the cache is (0..1) minus the replay lag relative to the allowed one (0..1).
+
+    >>> failover_score(1, 90426, 0.9, 0.1)
+    1263.2
+    >>> failover_score(1, 90426, 0.0, 0.0) > failover_score(1, 90425, 1.0, 0.0)
+    True
+    >>> failover_score(2, 90425, 0.0, 1.0) > failover_score(1, 90426, 1.0, 0.0)
+    True
+    """
+    return round(priority * 1000 + version % 100 * 10 + 4 * (warmth - lag), 3)
+
+
+def parse_setting(value, unit, vartype):
+    """ converts a value from the configuration or pg_settings into something comparable, `unit` and `vartype`
+        are the ones from pg_settings
+
+    >>> parse_setting('1GB', '8kB', 'integer') == parse_setting('131072', '8kB', 'integer')
+    True
+    >>> parse_setting('5min', 's', 'integer'), parse_setting(300, 's', 'integer')
+    (300, 300)
+    >>> parse_setting(True, None, 'bool'), parse_setting('Off', None, 'bool')
+    ('on', 'off')
+    >>> parse_setting('0.50', None, 'real'), parse_setting('Hot_Standby', None, 'enum')
+    (0.5, 'hot_standby')
+    >>> parse_setting('1 parsec', 'kB', 'integer')
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid value for unit kB: 1 parsec
+    """
+    if vartype == 'bool':
+        return BOOL_VALUES.get(str(value).lower(), str(value).lower())
+    if vartype == 'enum':
+        return str(value).lower()
+    if vartype not in ('integer', 'real'):
+        return str(value)
+
+    match = SETTING_RE.match(str(value))
+    if not match:
+        raise ValueError('invalid value for unit {}: {}'.format(unit, value))
+    number, value_unit = float(match.group(1)), match.group(2)
+    if value_unit:
+        unit_match = unit and UNIT_RE.match(unit)
+        if not unit_match or value_unit not in UNITS or (value_unit in ('kB', 'MB', 'GB', 'TB')) != \
+                (unit_match.group(2) in ('kB', 'MB', 'GB', 'TB')):
+            raise ValueError('invalid value for unit {}: {}'.format(unit, value))
+        number = number * UNITS[value_unit] / (int(unit_match.group(1) or 1) * UNITS[unit_match.group(2)])
+    return int(number) if vartype == 'integer' else number
+
 
 def parseurl(url):
     r = urlparse(url)
@@ -32,6 +101,20 @@ def parseurl(url):
     return ret
 
 
+def query_member(conn_url, sql, *params):
+    """ runs a single query on another member and returns the first row """
+    conn = psycopg2.connect(**parseurl(conn_url))
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+    finally:
+        conn.close()
+
+
 class Postgresql:
 
     def __init__(self, config, on_change_callback=None):
@@ -46,15 +129,71 @@ class Postgresql:
         self.configuration_to_save = (os.path.join(self.data_dir, 'pg_hba.conf'),
                                       os.path.join(self.data_dir, 'postgresql.conf'))
         self.postmaster_pid = os.path.join(self.data_dir, 'postmaster.pid')
+        self.parameters_file = os.path.join(self.data_dir, PARAMETERS_FILE)
+        self.pending_restart = []  # changed settings which only take effect after a restart
+        self.synchronous_mode = config.get('synchronous_mode', False)
+        self.synchronous_node_count = config.get('synchronous_node_count', 1)
+        self.synchronous_max_lag = config.get('synchronous_max_lag', 16 * 1024 * 1024)
+        self.synchronous_standby = []  # what synchronous_standby_names is set to
+        self.failover_score = None  # published with the member key, see `update_failover_score`
+        self.failover_rank = {}
+        self.buffercache_interval = config.get('buffercache_interval', 300)
+        self._buffer_occupancy = (0, None)
+        self.prewarmer = None
+        if 'prewarm' in config:
+            prewarm = config['prewarm'] or {}
+            self.prewarmer = Prewarmer(os.path.join(self.data_dir, 'governor_prewarm.json'), self.connect_database,
+                                       prewarm.get('rate', 32 * 1024 * 1024), prewarm.get('interval', 300),
+                                       prewarm.get('min_usage_count', 2))
         self.trigger_file = config.get('recovery_conf', {}).get('trigger_file', None) or 'promote'
         self.trigger_file = os.path.abspath(os.path.join(self.data_dir, self.trigger_file))
         self.is_promoted = False
+        self.use_pg_rewind = config.get('use_pg_rewind', False)
+        self.remove_data_directory_on_rewind_failure = config.get('remove_data_directory_on_rewind_failure', False)
+        self.use_delta_resync = config.get('use_delta_resync', False)
+        self.tags = config.get('tags', {})
+        self.replication_fanout = config.get('replication_fanout', 0)
+        self.upstream_check_interval = config.get('upstream_check_interval', 60)
+        self._upstream_checked = None  # the upstream, whether it runs as a replica and when we checked it
+        self.max_slot_wal_retention = config.get('max_slot_wal_retention', 0)
+        self.max_slot_inactive_time = config.get('max_slot_inactive_time', 0)
+        self.slot_park_time = config.get('slot_park_time', 600)
+        self.slots = {}
+        self.parked_slots = {}
+        self.dropped_slots = 0
+        self._slot_inactive_since = {}
+        self._parked_dropped = set()  # parked slots we have dropped, a member creates them again to resync
+        self.resync_stats = None
+        self.clone_progress = CloneProgress()
+        self.clone_costs = CloneCostModel(config.get('clone_stats_file', 'clone_stats.json'))
+        self.s3_backup_size = None
+        self.pending_catchup = None
+        self._stale_position = None
 
         self._pg_ctl = ['pg_ctl', '-w', '-D', self.data_dir]
         self.wal_e = config.get('wal_e', None)
         if self.wal_e:
             self.wal_e_path = 'envdir {} wal-e --aws-instance-profile '.\
                 format(self.wal_e.get('env_dir', '/home/postgres/etc/wal-e.d/env'))
+            self.backup_catalog = BackupCatalog(self.wal_e_path, self.wal_e.get('catalog_ttl', 300))
+
+        # set by governor, the archive_command hands the segments over to the archiver through the api
+        self.api_url = None
+        self.wal_archive = config.get('wal_archive', None)
+        self.archiver = None
+        self._next_archive_cleanup = 0
+        self._archive_cleanup = None
+        if self.wal_archive:
+            # relative to the data directory, which is where postgres runs the archive_command
+            self.wal_archive['archive_dir'] = os.path.abspath(os.path.join(self.data_dir,
+                                                                           self.wal_archive['archive_dir']))
+            self.archiver = wal_archive.WalArchiver(self.data_dir, self.wal_archive['archive_dir'],
+                                                    self.wal_archive.get('compression', 'gzip'),
+                                                    self.wal_archive.get('level'), self.wal_archive.get('workers', 4))
+            self.archive_index = WalIndex(self.wal_archive['archive_dir'],
+                                          self.wal_archive.get('rescan_interval', 86400))
+            self.archiver.on_archived = self.archive_index.append
+            self.archiver.start()
 
         self.local_address = self.get_local_address()
         connect_address = (config.get('connect_address', None) or self.local_address).format(**os.environ)
@@ -65,6 +204,7 @@ class Postgresql:
         self._cursor_holder = None
         self.members = []  # list of already existing replication slots
         self.on_change_callback = on_change_callback
+        self.role = None  # 'master' or 'replica' as last set or observed, None while postgres is not running
 
     def get_local_address(self):
         listen_addresses = self.listen_addresses.split(',')
@@ -83,6 +223,14 @@ class Postgresql:
             self._connection.autocommit = True
         return self._connection
 
+    def connect_database(self, database):
+        """ a new connection without statement_timeout, for the background workers """
+        r = parseurl('postgres://{}/{}'.format(self.local_address, database))
+        r['options'] = '-c statement_timeout=0'
+        conn = psycopg2.connect(**r)
+        conn.autocommit = True
+        return conn
+
     def _cursor(self):
         if not self._cursor_holder or self._cursor_holder.closed:
             self._cursor_holder = self.connection().cursor()
@@ -131,30 +279,73 @@ class Postgresql:
     def delete_trigger_file(self):
         os.path.exists(self.trigger_file) and os.unlink(self.trigger_file)
 
-    def sync_from_leader(self, leader):
+    def clone(self, cluster):
+        """ creates the replica, from another replica if allowed and possible, otherwise from the leader """
+        if self.config.get('clone_from_replicas', False):
+            max_lag = self.config.get('clone_max_lag', self.config.get('maximum_lag_on_failover', 0))
+            sources = clone_sources(cluster, self.name, max_lag)
+        else:
+            sources = [cluster.leader] if cluster.leader and cluster.leader.conn_url else []
+
+        for source in sources:
+            logger.info('cloning from %s', source.hostname)
+            if self.sync_from_leader(cluster.leader, source):
+                return True
+        return False
+
+    def remove_data_directory(self):
+        # pg_basebackup refuses to write into a non empty directory
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+
+    def sync_from_leader(self, leader, source=None):
         r = parseurl(leader.conn_url)
+        s = parseurl(source.conn_url) if source else r
 
         pgpass = self.config.get('pgpass_file', 'pgpass')
         with open(pgpass, 'w') as f:
             os.fchmod(f.fileno(), 0o600)
-            f.write('{host}:{port}:*:{user}:{password}\n'.format(**r))
+            for c in ((r, s) if s != r else (r,)):
+                f.write('{host}:{port}:*:{user}:{password}\n'.format(**c))
 
         env = os.environ.copy()
         env['PGPASSFILE'] = pgpass
-        return self.create_replica(r, env) == 0
+        return self.create_replica(r, env, s) == 0
 
-    def create_replica(self, master_connection, env):
+    def create_replica(self, master_connection, env, source_connection=None):
         """ creates a new replica using either pg_basebackup or WAL-E """
         if self.should_use_s3_to_create_replica(master_connection):
             result = self.create_replica_with_s3()
             # if restore from the backup on S3 failed - try with the pg_basebackup
             if result == 0:
                 return result
-        return self.create_replica_with_pg_basebackup(master_connection, env)
+        return self.create_replica_with_pg_basebackup(source_connection or master_connection, env)
+
+    def basebackup_command(self, master_connection):
+        max_rate = self.config.get('clone_max_rate')
+        # a fast checkpoint means a burst of writes on the source, don't do it when we were asked to go easy on it
+        checkpoint = self.config.get('clone_checkpoint', 'spread' if max_rate else 'fast')
+        cmd = ['pg_basebackup', '-R', '-D', self.data_dir, '--host=' + master_connection['host'],
+               '--port=' + str(master_connection['port']), '-U', master_connection['user'],
+               '-X', 'stream', '--checkpoint=' + checkpoint, '--label=governor clone', '--progress', '--verbose']
+        if max_rate:
+            cmd.append('--max-rate={}'.format(max_rate))
+        return cmd
 
     def create_replica_with_pg_basebackup(self, master_connection, env):
-        ret = subprocess.call(['pg_basebackup', '-R', '-D', self.data_dir, '--host=' + master_connection['host'],
-                               '--port=' + str(master_connection['port']), '-U', master_connection['user']], env=env)
+        attempts = self.config.get('clone_attempts', 3)
+        for attempt in range(1, attempts + 1):
+            self.clone_progress.start('pg_basebackup', master_connection['host'], attempt)
+            ret = run_basebackup(self.basebackup_command(master_connection), env, self.clone_progress)
+            self.clone_progress.finish(ret == 0)
+            if ret == 0:
+                status = self.clone_progress.status
+                self.clone_costs.observe('basebackup', status['bytes_total'], status['duration'])
+                break
+            logger.error('pg_basebackup from %s failed, attempt %s of %s', master_connection['host'], attempt, attempts)
+            self.remove_data_directory()
+            if attempt < attempts:
+                sleep(min(2 ** attempt, 60))
         self.delete_trigger_file()
         return ret
 
@@ -162,86 +353,163 @@ class Postgresql:
         if not self.wal_e or not self.wal_e_path:
             return 1
 
-        ret = subprocess.call(self.wal_e_path + ' backup-fetch {} LATEST'.format(self.data_dir), shell=True)
+        self.clone_progress.start('wal-e', 's3', 1)
+        pool_size = ' --pool-size={}'.format(self.wal_e['pool_size']) if self.wal_e.get('pool_size') else ''
+        ret = run_with_progress(self.wal_e_path + ' backup-fetch{} {} LATEST'.format(pool_size, self.data_dir),
+                                self.data_dir, self.s3_backup_size, self.clone_progress)
+        self.clone_progress.finish(ret == 0)
+        if ret == 0:
+            self.clone_costs.observe('s3_fetch', self.s3_backup_size, self.clone_progress.status['duration'])
+            if self.pending_catchup:
+                self.pending_catchup['started'] = time.time()
+        else:
+            self.pending_catchup = None
+            self.remove_data_directory()
         self.restore_configuration_files()
         return ret
 
     def should_use_s3_to_create_replica(self, master_connection):
-        """ determine whether it makes sense to use S3 and not pg_basebackup """
+        """ determine whether restoring the latest backup from S3 and replaying the WAL written since then is faster
+            than running pg_basebackup, based on the throughputs observed on this node """
         if not self.wal_e or not self.wal_e_path:
             return False
 
-        threshold_megabytes = self.wal_e.get('threshold_megabytes', 10240)
-        threshold_backup_size_percentage = self.wal_e.get('threshold_backup_size_percentage', 30)
-
-        try:
-            latest_backup = subprocess.check_output(self.wal_e_path.split() + ['backup-list', '--detail', 'LATEST'])
-            # name    last_modified   expanded_size_bytes wal_segment_backup_start    wal_segment_offset_backup_start wal_segment_backup_stop wal_segment_offset_backup_stop
-            # base_00000001000000000000007F_00000040  2015-05-18T10:13:25.000Z
-            # 20310671    00000001000000000000007F    00000040
-            # 00000001000000000000007F    00000240
-            backup_strings = latest_backup.splitlines() if latest_backup else ()
-            if len(backup_strings) != 2:
-                return False
-
-            names = backup_strings[0].split()
-            vals = backup_strings[1].split()
-            if (len(names) != len(vals)) or (len(names) != 7):
-                return False
-
-            backup_info = dict(zip(names, vals))
-        except subprocess.CalledProcessError as e:
-            logger.error("could not query wal-e latest backup: {}".format(e))
-            return False
-
-        try:
-            backup_size = backup_info['expanded_size_bytes']
-            backup_start_segment = backup_info['wal_segment_backup_start']
-            backup_start_offset = backup_info['wal_segment_offset_backup_start']
-        except Exception as e:
-            logger.error("unable to get some of S3 backup parameters: {}".format(e))
+        backup = self.backup_catalog.latest()
+        if not backup:
             return False
-
-        # WAL filename is XXXXXXXXYYYYYYYY000000ZZ, where X - timeline, Y - LSN logical log file,
-        # ZZ - 2 high digits of LSN offset. The rest of the offset is the provided decimal offset,
-        # that we have to convert to hex and 'prepend' to the high offset digits.
-
-        lsn_segment = backup_start_segment[8:16]
-        # first 2 characters of the result are 0x and the last one is L
-        lsn_offset = hex((long(backup_start_segment[16:32], 16) << 24) + long(backup_start_offset))[2:-1]
-
-        # construct the LSN from the segment and offset
-        backup_start_lsn = '{}/{}'.format(lsn_segment, lsn_offset)
+        self.s3_backup_size = backup['expanded_size_bytes']
 
         conn = None
         cursor = None
-        diff_in_bytes = long(backup_size)
         try:
-            # get the difference in bytes between the current WAL location and the backup start offset
             conn = psycopg2.connect(**master_connection)
             conn.autocommit = True
             cursor = conn.cursor()
-            cursor.execute("SELECT pg_xlog_location_diff(pg_current_xlog_location(), %s)", (backup_start_lsn,))
-            diff_in_bytes = long(cursor.fetchone()[0])
+            cursor.execute("""SELECT pg_current_xlog_location() - '0/0'::pg_lsn,
+                                     (SELECT sum(pg_database_size(oid)) FROM pg_database)""")
+            location, database_size = (int(v) for v in cursor.fetchone())
         except psycopg2.Error as e:
-            logger.error('could not determine difference with the master location: {}'.format(e))
+            logger.error('could not determine the location and the size of the master: {}'.format(e))
             return False
         finally:
             cursor and cursor.close()
             conn and conn.close()
 
-        # if the size of the accumulated WAL segments is more than a certan percentage of the backup size
-        # or exceeds the pre-determined size - pg_basebackup is chosen instead.
-        return (diff_in_bytes < long(threshold_megabytes) * 1048576) and\
-               (diff_in_bytes < long(backup_size) * float(threshold_backup_size_percentage) / 100)
+        wal_size = max(location - backup['start'], 0)
+        s3_time = self.clone_costs.estimate_s3(backup['expanded_size_bytes'], wal_size)
+        basebackup_time = self.clone_costs.estimate_basebackup(database_size)
+        logger.info('estimated replica creation time: %s seconds from S3, %s seconds with pg_basebackup',
+                    s3_time, basebackup_time)
+        if s3_time >= basebackup_time:
+            return False
+        # the replay rate is known when we reach the current master location
+        self.pending_catchup = {'location': location, 'wal_size': wal_size}
+        return True
+
+    def track_catchup(self):
+        """ records the WAL replay rate once a replica restored from S3 caught up with the master location at the
+            time of the restore """
+        catchup = self.pending_catchup
+        if catchup and 'started' in catchup and self.xlog_position() >= catchup['location']:
+            self.clone_costs.observe('wal_replay', catchup['wal_size'], time.time() - catchup['started'])
+            self.pending_catchup = None
+
+    def buffer_occupancy(self):
+        """ the share of shared_buffers in use, scanning pg_buffercache locks the buffer headers so the result is
+            kept for `buffercache_interval` seconds """
+        if self._buffer_occupancy[0] <= time.time():
+            occupancy = self.query('SELECT count(relfilenode)::float / count(*) FROM pg_buffercache').fetchone()[0]
+            self._buffer_occupancy = (time.time() + self.buffercache_interval, occupancy)
+        return self._buffer_occupancy[1]
+
+    def update_failover_score(self, cluster):
+        """ Computes how fit this replica is for a failover from the `priority` tag, the postgres version, the buffer
+            cache hit ratio, the occupancy of shared_buffers (with the pg_buffercache extension) and the replay lag.
+            Members with the `nofailover` tag have no score. """
+        if self.tags.get('nofailover'):
+            self.failover_score = None
+            self.failover_rank = {}
+            return
+        version, hit_ratio, position, has_buffercache = self.query(
+            """SELECT current_setting('server_version_num')::integer,
+                      (SELECT sum(blks_hit)::float / nullif(sum(blks_hit + blks_read), 0) FROM pg_stat_database),
+                      pg_last_xlog_replay_location() - '0/0'::pg_lsn,
+                      EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_buffercache')""").fetchone()
+        occupancy = self.buffer_occupancy() if has_buffercache else None
+        warmth = [value for value in (hit_ratio, occupancy) if value is not None]
+        warmth = sum(warmth) / len(warmth) if warmth else 0.0
+        max_lag = max(self.config.get('maximum_lag_on_failover', 0), WAL_SEGMENT_SIZE)
+        lag = min(max(cluster.last_leader_operation - int(position or 0), 0) / float(max_lag), 1.0)
+        try:
+            priority = int(self.tags.get('priority', 1))
+        except ValueError:
+            priority = 1
+        self.failover_score = failover_score(priority, version, warmth, lag)
+        self.failover_rank = {'score': self.failover_score, 'priority': priority, 'version': version,
+                              'hit_ratio': hit_ratio, 'buffer_occupancy': occupancy, 'lag': round(lag, 3)}
+
+    def update_prewarm_snapshot(self, leader=None):
+        """ see `Prewarmer.update` """
+        return self.prewarmer and self.prewarmer.update(leader)
+
+    def prewarm(self):
+        """ loads the blocks which were hot on the master into the cache """
+        return self.prewarmer and self.prewarmer.start(self.data_dir)
+
+    def cleanup_archive(self):
+        """ removes archived WAL needed neither by the retained base backups nor by a replication slot """
+        if not self.archiver or time.time() < self._next_archive_cleanup or \
+                self._archive_cleanup and self._archive_cleanup.is_alive():
+            return False
+        self._next_archive_cleanup = time.time() + self.wal_archive.get('cleanup_interval', 300)
+        slot = self.query("SELECT min(restart_lsn) - '0/0'::pg_lsn FROM pg_replication_slots").fetchone()[0]
+        # removing millions of files may take longer than the ttl of the leader lock
+        self._archive_cleanup = Thread(target=self._cleanup_archive,
+                                       args=(self.wal_archive.get('keep_backups', 2), slot and int(slot)))
+        self._archive_cleanup.daemon = True
+        self._archive_cleanup.start()
+        return True
+
+    def _cleanup_archive(self, keep_backups, min_position):
+        try:
+            self.archive_index.cleanup(keep_backups, min_position)
+        except (IOError, OSError):
+            logger.exception('cleanup of %s', self.wal_archive['archive_dir'])
+
+    def controldata(self):
+        """ returns the output of pg_controldata as a dict """
+        env = os.environ.copy()
+        env['LANG'] = env['LC_ALL'] = 'C'
+        try:
+            data = subprocess.check_output(['pg_controldata', self.data_dir], env=env).decode('utf-8')
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception('pg_controldata')
+            return {}
+        return dict(tuple(e.strip() for e in line.split(':', 1)) for line in data.splitlines() if ':' in line)
+
+    def checkpoint(self):
+        self.query('CHECKPOINT')
+
+    def set_role(self, role):
+        self.role = role
+        if self.on_change_callback:
+            self.on_change_callback(role)
 
     def is_leader(self):
         ret = not self.query('SELECT pg_is_in_recovery()').fetchone()[0]
+        self.role = 'master' if ret else 'replica'
         if ret and self.is_promoted:
             self.delete_trigger_file()
             self.is_promoted = False
         return ret
 
+    def read_postmaster_pid(self):
+        try:
+            with open(self.postmaster_pid) as f:
+                return int(f.readline().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
     def is_running(self):
         return subprocess.call(' '.join(self._pg_ctl) + ' status > /dev/null', shell=True) == 0
 
@@ -255,11 +523,14 @@ class Postgresql:
             os.remove(self.postmaster_pid)
             logger.info('Removed %s', self.postmaster_pid)
 
+        self.write_parameters()
         ret = subprocess.call(self._pg_ctl + ['start', '-o', self.server_options()]) == 0
+        if ret:
+            self.pending_restart = []
+            self.prewarm()
         ret and self.load_replication_slots()
         self.save_configuration_files()
-        if self.on_change_callback:
-            self.on_change_callback('replica' if os.path.exists(self.recovery_conf) else 'master')
+        self.set_role('replica' if os.path.exists(self.recovery_conf) else 'master')
         return ret
 
     def stop(self):
@@ -269,17 +540,125 @@ class Postgresql:
         return subprocess.call(self._pg_ctl + ['reload']) == 0
 
     def restart(self):
-        return subprocess.call(self._pg_ctl + ['restart', '-m', 'fast']) == 0
+        self.write_parameters()
+        ret = subprocess.call(self._pg_ctl + ['restart', '-m', 'fast']) == 0
+        if ret:
+            self.pending_restart = []
+            self.prewarm()
+        return ret
 
     def server_options(self):
-        options = "--listen_addresses='{}' --port={}".format(self.listen_addresses, self.port)
-        for setting, value in self.config['parameters'].items():
-            options += " --{}='{}'".format(setting, value)
-        return options
+        """ only what must differ per node goes to the command line, it would override every other setting """
+        return "--listen_addresses='{}' --port={}".format(self.listen_addresses, self.port)
+
+    def parameters(self):
+        parameters = dict(self.config.get('parameters', {}))
+        if self.archiver and 'archive_command' not in parameters:
+            parameters['archive_command'] = self.archive_command()
+        if self.synchronous_mode:
+            names = ', '.join('"{}"'.format(name) for name in self.synchronous_standby)
+            # with more than one name only the first connected standby would be synchronous before 9.6
+            parameters['synchronous_standby_names'] = '{} ({})'.format(len(self.synchronous_standby), names) \
+                if len(self.synchronous_standby) > 1 else names
+        return parameters
+
+    def write_parameters(self):
+        """ writes the parameters into `PARAMETERS_FILE`, included by postgresql.conf """
+        with open(self.parameters_file, 'w') as f:
+            f.write('# written by governor, changes will be overwritten\n')
+            for name, value in sorted(self.parameters().items()):
+                f.write("{} = '{}'\n".format(name, str(value).replace("'", "''")))
+
+        include = "include '{}'\n".format(PARAMETERS_FILE)
+        postgresql_conf = os.path.join(self.data_dir, 'postgresql.conf')
+        try:
+            with open(postgresql_conf) as f:
+                lines = f.readlines()
+        except IOError:
+            lines = []
+        if include not in lines:
+            with open(postgresql_conf, 'a') as f:
+                f.write(('\n' if lines and not lines[-1].endswith('\n') else '') + include)
+
+    def file_settings(self):
+        """ the settings in the configuration files as postgres would read them now, the last one of a name wins """
+        try:
+            return dict(self.query("""SELECT f.name, f.setting
+                                         FROM pg_file_settings f
+                                        ORDER BY f.seqno"""))
+        except psycopg2.Error:  # before 9.5
+            logger.warning('can not read pg_file_settings, removed parameters go back to their defaults')
+            return {}
+
+    def changed_parameters(self):
+        """ Compares the parameters with pg_settings, including the ones governor has set before and which are not
+            configured anymore. They go back to the value in postgresql.conf or to their defaults, so the parameters
+            file must have been written already. Returns the context of every changed setting. """
+        parameters = self.parameters()
+        file_settings = None
+        changed = {}
+        known = set()
+        for name, setting, unit, vartype, context, boot_val in self.query(
+                """SELECT name, setting, unit, vartype, context, boot_val
+                     FROM pg_settings
+                    WHERE name = ANY(%s) OR sourcefile = %s""",
+                sorted(parameters), os.path.abspath(self.parameters_file)):
+            known.add(name)
+            if name not in parameters and file_settings is None:
+                file_settings = self.file_settings()
+            try:
+                if parse_setting(parameters[name] if name in parameters else file_settings.get(name, boot_val),
+                                 unit, vartype) == \
+                        parse_setting(setting, unit, vartype):
+                    continue
+            except ValueError as e:
+                logger.warning('parameter %s: %s', name, e)
+            changed[name] = context
+        for name in set(parameters) - known:
+            # placeholders of extensions which are not loaded yet
+            changed[name] = 'user'
+        return changed
+
+    def reload_config(self, config):
+        """ Applies changed `parameters` without a restart whenever possible.
+
+            Settings with the postmaster context need a restart. Replicas are restarted right away, the master
+            keeps running and reports them as `pending_restart` until it is restarted. """
+        self.config['parameters'] = config.get('parameters', {})
+        if not self.is_running():
+            return
+        self.write_parameters()
+        changed = self.changed_parameters()
+        if not changed:
+            logger.info('no parameter changes')
+            return
+        restart = sorted(name for name, context in changed.items() if context == 'postmaster')
+        logger.info('changed parameters: %s', ', '.join(sorted(changed)))
+        if restart and not self.is_leader():
+            self.restart()
+        else:
+            self.reload()
+            if restart:
+                self.pending_restart = sorted(set(self.pending_restart) | set(restart))
+                logger.warning('restart postgres to apply %s', ', '.join(self.pending_restart))
+
+    @staticmethod
+    def script(module):
+        return '{} {}'.format(sys.executable, os.path.splitext(os.path.abspath(module.__file__))[0] + '.py')
+
+    def archive_command(self):
+        command = '{} push --archive-dir {} --compression {}'.format(
+            self.script(wal_archive), self.wal_archive['archive_dir'], self.archiver.compression)
+        if self.archiver.level is not None:
+            command += ' --level {}'.format(self.archiver.level)
+        if self.api_url:
+            command += ' --api-url ' + self.api_url
+        return command + ' %f'
 
     def is_healthy(self):
         if not self.is_running():
             logger.warning('Postgresql is not running.')
+            self.role = None
             return False
         return True
 
@@ -287,11 +666,19 @@ class Postgresql:
         if self.is_leader():
             return True
 
+        if self.tags.get('nofailover'):
+            return False
+
         if cluster.last_leader_operation - self.xlog_position() > self.config.get('maximum_lag_on_failover', 0):
             return False
 
+        # the synchronous standbys recorded by the former leader are known to have every commit
+        sync_standby = cluster.sync_standby()
+        prefer_sync = sync_standby and self.name not in sync_standby
+
+        max_lag = self.config.get('maximum_lag_on_failover', 0)
         for member in cluster.members:
-            if member.hostname == self.name:
+            if member.hostname == self.name or member.tags.get('nofailover'):
                 continue
             try:
                 r = parseurl(member.conn_url)
@@ -305,7 +692,11 @@ class Postgresql:
                 member_cursor.close()
                 member_conn.close()
                 logger.error([self.name, member.hostname, row])
-                if not row[0] or row[1] < 0:
+                if not row[0] or row[1] < 0 or prefer_sync and member.hostname in sync_standby:
+                    return False
+                # among the members close enough to our position the one with the best score wins
+                if row[1] <= max_lag and member.score is not None and self.failover_score is not None and \
+                        member.score > self.failover_score:
                     return False
             except psycopg2.Error:
                 continue
@@ -320,44 +711,65 @@ class Postgresql:
                 f.write(line + '\n')
 
     @staticmethod
-    def primary_conninfo(leader_url):
+    def primary_conninfo(leader_url, application_name):
         r = parseurl(leader_url)
-        return 'user={user} password={password} host={host} port={port} sslmode=prefer sslcompression=1'.format(**r)
+        return ('user={user} password={password} host={host} port={port} sslmode=prefer sslcompression=1 ' +
+                'application_name={application_name}').format(application_name=application_name, **r)
 
-    def check_recovery_conf(self, leader):
+    def check_recovery_conf(self, leader, slot=True):
         if not os.path.isfile(self.recovery_conf):
             return False
 
-        pattern = leader and leader.conn_url and self.primary_conninfo(leader.conn_url)
+        pattern = leader and leader.conn_url and self.primary_conninfo(leader.conn_url, self.name)
 
         with open(self.recovery_conf, 'r') as f:
-            for line in f:
-                if line.startswith('primary_conninfo'):
-                    if not pattern:
-                        return False
-                    return pattern in line
+            lines = f.readlines()
+        for line in lines:
+            if line.startswith('primary_conninfo'):
+                if not pattern or pattern not in line:
+                    return False
+                return slot == any(line.startswith('primary_slot_name') for line in lines)
 
         return not pattern
 
-    def write_recovery_conf(self, leader):
+    def write_recovery_conf(self, leader, slot=True):
         with open(self.recovery_conf, 'w') as f:
             f.write("""standby_mode = 'on'
 recovery_target_timeline = 'latest'
 """)
             if leader and leader.conn_url:
+                if slot:
+                    f.write("\nprimary_slot_name = '{}'".format(self.name))
                 f.write("""
-primary_slot_name = '{}'
 primary_conninfo = '{}'
-""".format(self.name, self.primary_conninfo(leader.conn_url)))
+""".format(self.primary_conninfo(leader.conn_url, self.name)))
                 for name, value in self.config.get('recovery_conf', {}).items():
                     f.write("{} = '{}'\n".format(name, value))
-
-    def follow_the_leader(self, leader):
-        if not self.check_recovery_conf(leader):
-            self.write_recovery_conf(leader)
+            restore_command = self.wal_restore_command()
+            if restore_command and 'restore_command' not in self.config.get('recovery_conf', {}):
+                f.write("restore_command = '{}'\n".format(restore_command))
+
+    def wal_restore_command(self):
+        """ restore_command fetching the following segments in parallel, from WAL-E or from our own archive """
+        if self.wal_e and self.wal_e.get('prefetch'):
+            settings = self.wal_e
+            source = '--wal-e-env-dir ' + self.wal_e.get('env_dir', '/home/postgres/etc/wal-e.d/env')
+        elif self.wal_archive:
+            settings = self.wal_archive
+            source = '--archive-dir ' + self.wal_archive['archive_dir']
+        else:
+            return None
+        spool_dir = settings.get('spool_dir', os.path.join(self.data_dir, 'pg_xlog', '.governor_prefetch'))
+        return '{} {} --spool-dir {} --prefetch {} %f %p'.format(
+            self.script(wal_restore), source, os.path.abspath(spool_dir), settings.get('prefetch', 8))
+
+    def follow_the_leader(self, leader, slot=True):
+        if not self.check_recovery_conf(leader, slot):
+            self.write_recovery_conf(leader, slot)
+            # commits would wait for our former synchronous standbys after a promotion
+            self.synchronous_standby = []
             self.restart()
-            if self.on_change_callback:
-                self.on_change_callback('replica')
+            self.set_role('replica')
 
     def save_configuration_files(self):
         """
@@ -376,13 +788,181 @@ primary_conninfo = '{}'
             logger.error("unable to restore configuration from WAL-E backup: {}".format(e))
 
     def promote(self):
+        self.failover_score = None
         self.is_promoted = subprocess.call(self._pg_ctl + ['promote']) == 0
-        if self.on_change_callback:
-            self.on_change_callback('master')
+        # the cache of a replica holds what the read queries needed, not what the master was busy with
+        self.is_promoted and self.prewarm()
+        self.set_role('master')
         return self.is_promoted
 
     def demote(self, leader):
-        self.follow_the_leader(leader)
+        if leader and leader.conn_url and self.can_rejoin():
+            # we might have written WAL the new leader never got, this can only be checked on a stopped cluster
+            self.stop()
+            if not self.rejoin(leader):
+                # a diverged data directory must not be started, the HA loop tries again while it is stopped
+                return logger.error('can not rejoin %s', leader.hostname)
+            self.write_recovery_conf(leader)
+            self.synchronous_standby = []
+            self.start()
+        else:
+            self.follow_the_leader(leader)
+
+    def can_rejoin(self):
+        return self.use_pg_rewind or self.use_delta_resync or self.remove_data_directory_on_rewind_failure
+
+    @staticmethod
+    def parse_history(data):
+        """
+        >>> Postgresql.parse_history('1\\t0/3000090\\tno recovery target specified\\n\\n2\\t0/5000000\\tfoo')
+        [(1, 50331792), (2, 83886080)]
+        """
+        if not isinstance(data, str):
+            data = bytes(data).decode('utf-8')
+        ret = []
+        for line in data.splitlines():
+            values = line.strip().split('\t')
+            if len(values) > 1 and values[0].isdigit():
+                ret.append((int(values[0]), lsn_to_bytes(values[1])))
+        return ret
+
+    @staticmethod
+    def timeline_diverged(timeline, location, leader_timeline, leader_location, history):
+        """ checks whether our last checkpoint is part of the leader's history
+
+        >>> Postgresql.timeline_diverged(1, 100, 1, 200, [])
+        False
+        >>> Postgresql.timeline_diverged(1, 100, 2, 200, [(1, 150)])
+        False
+        >>> Postgresql.timeline_diverged(1, 150, 2, 200, [(1, 150)])
+        True
+        >>> Postgresql.timeline_diverged(3, 100, 2, 200, [(1, 50)])
+        True
+        """
+        if timeline == leader_timeline:
+            return location > leader_location
+        for tli, switchpoint in history:
+            if tli == timeline:
+                return location >= switchpoint
+        return True  # the leader's timeline doesn't descend from ours
+
+    def leader_timeline(self, leader):
+        """ returns the timeline, the current WAL position and the timeline history of the leader """
+        conn = psycopg2.connect(connection_factory=PhysicalReplicationConnection, **parseurl(leader.conn_url))
+        try:
+            cursor = conn.cursor()
+            cursor.execute('IDENTIFY_SYSTEM')
+            timeline, location = cursor.fetchone()[1:3]
+            history = []
+            if int(timeline) > 1:
+                cursor.execute('TIMELINE_HISTORY {}'.format(timeline))
+                history = self.parse_history(cursor.fetchone()[1])
+            return int(timeline), lsn_to_bytes(location), history
+        finally:
+            conn.close()
+
+    def single_user_recovery(self):
+        """ pg_rewind needs a cleanly shut down data directory, single user mode runs crash recovery for us """
+        with open(os.devnull) as devnull:
+            return subprocess.call(['postgres', '--single', '-D', self.data_dir, 'postgres'], stdin=devnull) == 0
+
+    def leader_superuser_params(self, leader):
+        r = parseurl(leader.conn_url)
+        r['user'] = self.superuser.get('username', 'postgres')
+        r['password'] = self.superuser.get('password', '')
+        return r
+
+    def rewind(self, leader):
+        r = self.leader_superuser_params(leader)
+        env = os.environ.copy()
+        env['PGPASSWORD'] = r['password']
+        source = 'host={host} port={port} dbname=postgres user={user}'.format(**r)
+        return subprocess.call(['pg_rewind', '-D', self.data_dir, '--source-server', source], env=env) == 0
+
+    def delta_resync(self, leader):
+        """ copies only changed chunks of the stopped data directory from the leader """
+        try:
+            self.resync_stats = Resync(self.data_dir, self.leader_superuser_params(leader),
+                                       self.config.get('resync_chunk_size', 131072), self.name).run()
+            return True
+        except (psycopg2.Error, IOError, OSError):
+            logger.exception('delta resync from %s', leader.hostname)
+            return False
+
+    def is_stale(self, cluster):
+        """ A replica which needs WAL the leader has already removed will never catch up by streaming. We only ask
+            the leader when we are behind it and our replay position didn't move since the last check. """
+        if not self.use_delta_resync or not (cluster.leader and cluster.leader.conn_url):
+            return False
+        position = self.xlog_position()
+        stuck, self._stale_position = position == self._stale_position, position
+        if not stuck or position >= (cluster.last_leader_operation or 0):
+            return False
+
+        try:
+            conn = psycopg2.connect(**self.leader_superuser_params(cluster.leader))
+            try:
+                cursor = conn.cursor()
+                # segments of former timelines may linger, only the current one is being removed
+                cursor.execute("""SELECT min(name) FROM pg_ls_dir('pg_xlog') name
+                                   WHERE name ~ '^[0-9A-F]{24}$'
+                                     AND left(name, 8) = (SELECT max(left(n, 8)) FROM pg_ls_dir('pg_xlog') n
+                                                           WHERE n ~ '^[0-9A-F]{24}$')""")
+                oldest = cursor.fetchone()[0]
+            finally:
+                conn.close()
+        except psycopg2.Error:
+            logger.exception('can not get the oldest WAL segment of %s', cluster.leader.hostname)
+            return False
+        return bool(oldest) and position < segment_to_bytes(oldest)
+
+    def resync_from_leader(self, leader):
+        self.stop()
+        ret = self.delta_resync(leader)
+        self.write_recovery_conf(leader)
+        self.start()
+        return ret
+
+    def rejoin(self, leader):
+        """ Prepares the stopped data directory to follow the leader. If our timeline has diverged from the leader's
+            one it is rewound with pg_rewind or, when that's impossible, cloned from the leader from scratch.
+
+            Returns False when the data directory is not ready to follow the leader, it must not be started then. """
+        if not os.path.exists(self.data_dir):  # cloning from scratch failed, the next run tries it again
+            return bool(leader and leader.conn_url) and self.sync_from_leader(leader)
+        if not (leader and leader.conn_url) or not self.can_rejoin():
+            return True
+
+        data = self.controldata()
+        if data.get('Database cluster state') == 'in production':  # crashed master
+            if not self.single_user_recovery():
+                logger.error('crash recovery in single user mode failed')
+            data = self.controldata()
+        if data.get('Database cluster state') not in ('shut down', 'shut down in recovery'):
+            return True
+
+        try:
+            leader_timeline = self.leader_timeline(leader)
+        except psycopg2.Error:
+            logger.exception('can not get the timeline history of %s', leader.hostname)
+            return False
+
+        location = lsn_to_bytes(data.get('Latest checkpoint location', ''))
+        timeline = int(data.get("Latest checkpoint's TimeLineID", 0))
+        if not self.timeline_diverged(timeline, location, *leader_timeline):
+            return True
+
+        logger.info('timeline %s diverged from the timeline %s of %s', timeline, leader_timeline[0], leader.hostname)
+        if self.use_pg_rewind and self.rewind(leader):
+            return True
+        if self.use_delta_resync and self.delta_resync(leader):
+            return True
+        if self.remove_data_directory_on_rewind_failure:
+            logger.warning('can not rewind, cloning %s from scratch', leader.hostname)
+            shutil.rmtree(self.data_dir)
+            return self.sync_from_leader(leader)
+        logger.error('can not rewind and removing the data directory is not allowed')
+        return False
 
     def create_replication_user(self):
         self.query('CREATE USER "{}" WITH REPLICATION ENCRYPTED PASSWORD %s'.format(
@@ -408,20 +988,133 @@ primary_conninfo = '{}'
         cursor = self.query("SELECT slot_name FROM pg_replication_slots WHERE slot_type='physical'")
         self.members = [r[0] for r in cursor]
 
+    def upstream(self, cluster):
+        """ returns the member to stream from and whether it keeps a replication slot for us
+
+            A cascading replica falls back to the leader while its upstream is not running as a replica. The
+            leader keeps no slot for it then, the slot lives on the upstream. Neither is there a slot while the
+            upstream has parked it (see `park_slot`).
+
+            Whether the upstream runs as a replica is remembered until the topology changes, but at most
+            `upstream_check_interval` seconds, instead of connecting to it on every run of the HA loop. """
+        leader = cluster.leader
+        name = cluster.replication_topology(self.replication_fanout).get(self.name)
+        if not leader or name in (None, leader.hostname):
+            return leader, not leader or self.name not in leader.parked_slots
+
+        member = [m for m in cluster.members if m.hostname == name][0]
+        now = time.time()
+        checked = self._upstream_checked
+        if checked and checked[0] == (name, member.conn_url) and now - checked[2] < self.upstream_check_interval:
+            available = checked[1]
+        else:
+            available = False
+            try:
+                available = bool(member.conn_url and query_member(member.conn_url, 'SELECT pg_is_in_recovery()')[0])
+            except psycopg2.Error:
+                pass
+            self._upstream_checked = ((name, member.conn_url), available, now)
+            if not available:
+                logger.warning('upstream %s is not available, streaming from the leader', name)
+        if available:
+            return member, self.name not in member.parked_slots
+        return leader, False
+
+    def park_slot(self, name, reason):
+        logger.warning('dropping the replication slot %s for %s seconds: %s', name, self.slot_park_time, reason)
+        self.parked_slots[name] = time.time() + self.slot_park_time
+
     def create_replication_slots(self, cluster):
-        members = [m.hostname for m in cluster.members if m.hostname != self.name]
-        # drop unused slots
-        for slot in set(self.members) - set(members):
-            self.query("""SELECT pg_drop_replication_slot(%s)
-                           WHERE EXISTS(SELECT 1 FROM pg_replication_slots
-                           WHERE slot_name = %s)""", slot, slot)
-
-        # create new slots
-        for slot in set(members) - set(self.members):
-            self.query("""SELECT pg_create_physical_replication_slot(%s)
-                           WHERE NOT EXISTS (SELECT 1 FROM pg_replication_slots
-                           WHERE slot_name = %s)""", slot, slot)
-        self.members = members
+        """ Makes sure there is a slot for every member streaming from us and no other one.
+
+            The WAL retained by every slot is checked on every run. Slots retaining more than
+            `max_slot_wal_retention` bytes or inactive for longer than `max_slot_inactive_time` seconds are dropped
+            and not created again for `slot_park_time` seconds. The member can catch up from the archive meanwhile,
+            instead of filling up the disk of the primary. """
+        now = time.time()
+        topology = cluster.replication_topology(self.replication_fanout)
+        self.parked_slots = dict((name, until) for name, until in self.parked_slots.items() if until > now)
+        self._parked_dropped.intersection_update(self.parked_slots)
+        wanted = set(name for name, upstream in topology.items() if upstream == self.name) - set(self.parked_slots)
+
+        slots = {}
+        terminate = []
+        for name, active, pid, retained in self.query("""SELECT slot_name, active, active_pid,
+                                                                CASE WHEN pg_is_in_recovery()
+                                                                     THEN pg_last_xlog_replay_location()
+                                                                     ELSE pg_current_xlog_location()
+                                                                 END - restart_lsn
+                                                           FROM pg_replication_slots
+                                                          WHERE slot_type = 'physical'"""):
+            retained = int(retained or 0)
+            if name in self._parked_dropped and topology.get(name) == self.name:
+                # we dropped it already, the member created it again to resync from us
+                logger.info('the replication slot %s was created again, it is not parked any more', name)
+                self.parked_slots.pop(name, None)
+                self._parked_dropped.discard(name)
+                wanted.add(name)
+            inactive_since = None if active else self._slot_inactive_since.get(name, now)
+            slots[name] = {'active': active, 'retained_bytes': retained, 'inactive_since': inactive_since}
+            if name in wanted:
+                inactive_time = 0 if inactive_since is None else now - inactive_since
+                if self.max_slot_wal_retention and retained > self.max_slot_wal_retention:
+                    self.park_slot(name, 'it retains {} bytes of WAL'.format(retained))
+                elif self.max_slot_inactive_time and inactive_time > self.max_slot_inactive_time:
+                    self.park_slot(name, 'inactive for {} seconds'.format(int(inactive_time)))
+                if name in self.parked_slots:
+                    wanted.discard(name)
+            if name not in wanted and active and pid:
+                # the slot can be dropped on the next run, when the walsender is gone
+                terminate.append(pid)
+        self._slot_inactive_since = dict((n, s['inactive_since']) for n, s in slots.items() if s['inactive_since'])
+
+        drop = [name for name, slot in slots.items() if name not in wanted and not slot['active']]
+        create = [name for name in wanted if name not in slots]
+        if terminate or create:
+            self.query("""SELECT (SELECT count(pg_terminate_backend(pid)) FROM unnest(%s::integer[]) pid),
+                                 (SELECT count(pg_create_physical_replication_slot(name))
+                                    FROM unnest(%s::text[]) name)""", terminate, create)
+        for name in drop:
+            # a replica may have connected to the slot in the meantime, it is dropped on a later run then
+            try:
+                self.query('SELECT pg_drop_replication_slot(%s)', name)
+            except psycopg2.Error as e:
+                logger.warning('could not drop the replication slot %s: %s', name, e)
+                continue
+            self.dropped_slots += 1
+            slots.pop(name)
+            if name in self.parked_slots:
+                self._parked_dropped.add(name)
+        for name in create:
+            slots[name] = {'active': False, 'retained_bytes': 0, 'inactive_since': now}
+        self.slots = slots
+        self.members = sorted(wanted)
+
+    def pick_synchronous_standby(self, cluster):
+        """ Chooses up to `synchronous_node_count` members streaming from us with a flush lag below
+            `synchronous_max_lag` bytes. The current synchronous standbys are kept as long as they qualify, the
+            others are ranked by their lag. Members with the `nosync` tag are never chosen. """
+        members = dict((m.hostname, m) for m in cluster.members if not m.tags.get('nosync'))
+        candidates = []
+        for name, flush_lag in self.query("""SELECT application_name, pg_current_xlog_location() - flush_location
+                                               FROM pg_stat_replication
+                                              WHERE state = 'streaming'"""):
+            if name in members and flush_lag is not None and int(flush_lag) <= self.synchronous_max_lag:
+                candidates.append((name not in self.synchronous_standby, int(flush_lag), name))
+        return sorted(name for _, _, name in sorted(candidates)[:self.synchronous_node_count])
+
+    def set_synchronous_standby(self, names):
+        """ sets synchronous_standby_names with a reload, if it has changed """
+        if names != self.synchronous_standby:
+            logger.info('synchronous standbys: %s', ', '.join(names) or 'none')
+            self.synchronous_standby = names
+            self.write_parameters()
+            self.reload()
+
+    def slots_status(self):
+        return {'slots': self.slots, 'parked': dict((n, int(until)) for n, until in self.parked_slots.items()),
+                'dropped': self.dropped_slots, 'max_wal_retention': self.max_slot_wal_retention,
+                'max_inactive_time': self.max_slot_inactive_time}
 
     def last_operation(self):
         return self.xlog_position()
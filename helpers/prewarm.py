@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import psycopg2
+import requests
+import time
+
+from helpers.utils import api_base_url, sleep
+from requests.exceptions import RequestException
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 8192
+SEGMENT_BLOCKS = 131072  # blocks per 1GB segment file
+CHUNK_BLOCKS = 1024
+FORK_SUFFIXES = ('', '_fsm', '_vm', '_init')
+DEFAULT_TABLESPACE = 1663
+GLOBAL_TABLESPACE = 1664
+
+# consecutive hot blocks of a relation fork become one range
+SNAPSHOT_QUERY = """SELECT reldatabase, reltablespace, relfilenode, relforknumber, min(relblocknumber),
+                           max(relblocknumber)
+                      FROM (SELECT reldatabase, reltablespace, relfilenode, relforknumber, relblocknumber,
+                                   relblocknumber - row_number() OVER (PARTITION BY reldatabase, reltablespace,
+                                                                                    relfilenode, relforknumber
+                                                                           ORDER BY relblocknumber) AS grp
+                              FROM pg_buffercache
+                             WHERE relfilenode IS NOT NULL AND usagecount >= %s) b
+                     GROUP BY 1, 2, 3, 4, grp
+                     ORDER BY 1, 2, 3, 4, 5"""
+
+
+def relation_path(data_dir, database, tablespace, filenode, fork):
+    """
+    >>> relation_path('data', 16384, 1663, 16385, 0)
+    'data/base/16384/16385'
+    >>> relation_path('data', 0, 1664, 1262, 2)
+    'data/global/1262_vm'
+    """
+    name = str(filenode) + FORK_SUFFIXES[fork]
+    if tablespace == GLOBAL_TABLESPACE:
+        return os.path.join(data_dir, 'global', name)
+    if tablespace == DEFAULT_TABLESPACE:
+        return os.path.join(data_dir, 'base', str(database), name)
+    location = os.path.join(data_dir, 'pg_tblspc', str(tablespace))
+    version_dirs = [d for d in os.listdir(location) if d.startswith('PG_')]
+    return os.path.join(location, version_dirs[0], str(database), name)
+
+
+def chunks(first, last):
+    """ splits a range of blocks at chunk and segment file boundaries
+
+    >>> list(chunks(131000, 132100))
+    [(131000, 131071), (131072, 132095), (132096, 132100)]
+    """
+    while first <= last:
+        end = min(last, (first // CHUNK_BLOCKS + 1) * CHUNK_BLOCKS - 1,
+                  (first // SEGMENT_BLOCKS + 1) * SEGMENT_BLOCKS - 1)
+        yield first, end
+        first = end + 1
+
+
+def read_blocks(path, first, last):
+    """ brings the blocks into the page cache of the OS, for databases without pg_prewarm """
+    segment = first // SEGMENT_BLOCKS
+    try:
+        with open(path + ('.{}'.format(segment) if segment else ''), 'rb') as f:
+            f.seek((first % SEGMENT_BLOCKS) * BLOCK_SIZE)
+            f.read((last - first + 1) * BLOCK_SIZE)
+    except (IOError, OSError):
+        pass  # the relation was dropped or truncated in the meantime
+
+
+class Prewarmer:
+    """ Keeps a snapshot of the hot blocks of the primary in `path` and loads them into the cache after a restart or
+        a promotion.
+
+        The master takes the snapshot from pg_buffercache, replicas fetch it from the master. A background thread
+        loads the blocks with pg_prewarm into shared_buffers, or into the page cache of the OS for databases
+        without the extension. It reads at most `rate` bytes per second so that it doesn't compete with the
+        queries the node is serving meanwhile. """
+
+    def __init__(self, path, connect, rate=32 * 1024 * 1024, interval=300, min_usage_count=2):
+        self.path = path
+        self.connect = connect  # returns a connection to the given database
+        self.rate = rate
+        self.interval = interval
+        self.min_usage_count = min_usage_count
+        self.next_update = 0
+        self.updater = None
+        self.thread = None
+        self.lock = Lock()
+        self.progress = {'state': 'idle', 'blocks_done': 0, 'blocks_total': 0}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, snapshot):
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            logger.exception('could not save the prewarm snapshot to %s', self.path)
+
+    def take_snapshot(self):
+        conn = self.connect('postgres')
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_buffercache')")
+            if not cursor.fetchone()[0]:
+                logger.warning('the pg_buffercache extension is needed for prewarm snapshots')
+                return
+            cursor.execute(SNAPSHOT_QUERY, (self.min_usage_count,))
+            ranges = [list(row) for row in cursor]
+        finally:
+            conn.close()
+        self.save({'created': time.time(), 'ranges': ranges})
+        logger.info('prewarm snapshot of %s hot blocks', sum(r[5] - r[4] + 1 for r in ranges))
+
+    def fetch_snapshot(self, leader, timeout=10):
+        try:
+            snapshot = requests.get(api_base_url(leader.api_url) + '/prewarm', timeout=timeout).json()
+        except (RequestException, ValueError):
+            logger.warning('could not fetch the prewarm snapshot from %s', leader.hostname)
+            return
+        if isinstance(snapshot, dict) and isinstance(snapshot.get('ranges'), list):
+            self.save({'created': snapshot.get('created'), 'ranges': snapshot['ranges']})
+
+    def update_snapshot(self, leader=None):
+        """ every `interval` seconds the master takes a snapshot, replicas fetch the one of the `leader` """
+        if not leader:
+            try:
+                self.take_snapshot()
+            except psycopg2.Error as e:
+                logger.error('could not take a prewarm snapshot: %s', e)
+        elif leader.api_url:
+            self.fetch_snapshot(leader)
+
+    def update(self, leader=None):
+        """ runs `update_snapshot` in the background when it is due, so that the HA loop isn't delayed """
+        now = time.time()
+        if now < self.next_update or self.updater and self.updater.is_alive():
+            return False
+        self.next_update = now + self.interval
+        self.updater = Thread(target=self.update_snapshot, args=(leader,))
+        self.updater.daemon = True
+        self.updater.start()
+        return True
+
+    def throttle(self, started, blocks_done):
+        ahead = float(blocks_done * BLOCK_SIZE) / self.rate - (time.time() - started)
+        ahead > 0 and sleep(ahead)
+
+    def database_names(self):
+        conn = self.connect('postgres')
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT oid, datname FROM pg_database WHERE datallowconn')
+            return dict(cursor.fetchall())
+        finally:
+            conn.close()
+
+    def relations(self, cursor):
+        """ maps the filenodes on the relations, if the database has the pg_prewarm extension """
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm')")
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute("""SELECT pg_relation_filenode(oid), oid
+                            FROM pg_class
+                           WHERE pg_relation_filenode(oid) IS NOT NULL""")
+        return dict(cursor.fetchall())
+
+    def run(self, data_dir, ranges):
+        started = time.time()
+        self.progress = {'state': 'running', 'blocks_done': 0, 'blocks_total': sum(r[5] - r[4] + 1 for r in ranges),
+                         'started': int(started)}
+        try:
+            databases = self.database_names()
+            by_database = {}
+            for r in ranges:
+                by_database.setdefault(r[0], []).append(r)
+            for database, database_ranges in sorted(by_database.items()):
+                conn = cursor = relations = None
+                if database in databases:
+                    try:
+                        conn = self.connect(databases[database])
+                        cursor = conn.cursor()
+                        relations = self.relations(cursor)
+                    except psycopg2.Error:
+                        logger.warning('prewarming %s without pg_prewarm', databases[database])
+                try:
+                    for _, tablespace, filenode, fork, first, last in database_ranges:
+                        for start, end in chunks(first, last):
+                            if relations and filenode in relations:
+                                try:
+                                    cursor.execute("SELECT pg_prewarm(%s::regclass, 'buffer', %s, %s, %s)",
+                                                   (relations[filenode], ['main', 'fsm', 'vm', 'init'][fork],
+                                                    start, end))
+                                except psycopg2.Error as e:  # dropped or truncated in the meantime
+                                    logger.debug('prewarm: %s', e)
+                            else:
+                                read_blocks(relation_path(data_dir, database, tablespace, filenode, fork), start, end)
+                            self.progress['blocks_done'] += end - start + 1
+                            self.throttle(started, self.progress['blocks_done'])
+                finally:
+                    conn and conn.close()
+            self.progress['state'] = 'done'
+        except (psycopg2.Error, OSError, IndexError) as e:
+            logger.error('prewarm failed: %s', e)
+            self.progress['state'] = 'failed'
+        self.progress['duration'] = round(time.time() - started, 3)
+        logger.info('prewarmed %s blocks in %s seconds', self.progress['blocks_done'], self.progress['duration'])
+
+    def start(self, data_dir):
+        """ starts loading the last snapshot in the background, unless it is already running """
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return False
+            snapshot = self.load()
+            if not snapshot or not snapshot.get('ranges'):
+                return False
+            self.thread = Thread(target=self.run, args=(data_dir, snapshot['ranges']))
+            self.thread.daemon = True
+            self.thread.start()
+            return True
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+""" A TCP proxy inside governor which forwards client connections to the current leader.
+
+    The proxy follows the leader through the version counter of the HA loop (see `Ha.watch`) instead of polling
+    the REST API of every node. Connections to a former leader are cut as soon as the leader changed.
+
+    usage: proxy.py benchmark [--megabytes N] [--round-trips N]
+"""
+import argparse
+import logging
+import socket
+import sys
+import time
+
+from threading import Thread
+
+try:
+    import asyncio
+except ImportError:  # python 2
+    asyncio = None
+
+if sys.hexversion >= 0x03000000:
+    from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+    from urllib.parse import urlparse
+else:
+    from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
+    from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+Protocol = asyncio.Protocol if asyncio else object
+CHUNK_SIZE = 262144
+
+
+class Pipe(Protocol):
+    """ One side of a proxied connection, everything received is written to the `peer`. When the write buffer of
+        one side fills up, reading from the other side is paused until it is drained again. """
+
+    proxy = peer = transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(self.proxy.buffer_size)
+
+    def data_received(self, data):
+        self.peer.transport.write(data)
+
+    def pause_writing(self):
+        self.peer and self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer and self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.peer and self.peer.transport.close()
+
+
+class Upstream(Pipe):
+
+    def __init__(self, client):
+        self.proxy = client.proxy
+        self.peer = client
+
+
+class Client(Pipe):
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.target = None
+
+    def connection_made(self, transport):
+        Pipe.connection_made(self, transport)
+        self.target = self.proxy.target
+        if not self.target:
+            return transport.close()
+        # nothing is read from the client before the leader accepted the connection
+        transport.pause_reading()
+        self.proxy.clients.add(self)
+        connect = self.proxy.loop.create_connection(lambda: Upstream(self), *self.target)
+        self.proxy.loop.create_task(asyncio.wait_for(connect, self.proxy.connect_timeout)).add_done_callback(
+            self.upstream_connected)
+
+    def upstream_connected(self, task):
+        if task.cancelled() or task.exception():
+            logger.warning('could not connect to %s:%s', *self.target)
+            return self.transport.close()
+        transport, self.peer = task.result()
+        if self.transport.is_closing():
+            return transport.close()
+        self.transport.resume_reading()
+
+    def cut(self):
+        """ drops the connection without waiting for the buffered data, the other side may be gone already """
+        self.transport.abort()
+        self.peer and self.peer.transport.abort()
+
+    def connection_lost(self, exc):
+        self.proxy.clients.discard(self)
+        Pipe.connection_lost(self, exc)
+
+
+class LeaderProxy(Thread):
+    """ Listens on `listen` and forwards every connection to the leader of the cluster. The connections are
+        handled by an asyncio event loop in a thread of its own, this thread waits for changes of the leader. """
+
+    def __init__(self, governor, config):
+        if not asyncio:
+            raise ValueError('the proxy needs python 3')
+        Thread.__init__(self, target=self.follow_leader)
+        self.daemon = True
+        self.governor = governor
+        host, port = config['listen'].split(':')
+        self.address = (host, int(port))
+        self.buffer_size = config.get('buffer_size', 1048576)  # bytes buffered per direction and connection
+        self.connect_timeout = config.get('connect_timeout', 5)
+        self.target = None  # host and port of the leader
+        self.clients = set()
+        self.loop = None
+        self.server = None
+
+    def start_server(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: Client(self), self.address[0], self.address[1], reuse_address=True))
+        self.address = self.server.sockets[0].getsockname()[:2]
+        thread = Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+    def start(self):
+        self.start_server()
+        Thread.start(self)
+
+    def set_target(self, target):
+        """ runs in the event loop, new connections go to `target` and the ones to other hosts are cut """
+        if target != self.target:
+            logger.info('proxy target: %s', target and '{}:{}'.format(*target))
+        self.target = target
+        for client in list(self.clients):
+            if client.target != target:
+                client.cut()
+
+    def leader_address(self, leader):
+        """ host and port of the `leader` from its member key, or from our own connection string """
+        conn_url = None
+        cluster = self.governor.ha.cluster
+        for member in cluster and cluster.members or []:
+            if member.hostname == leader:
+                conn_url = member.conn_url
+        if not conn_url and leader == self.governor.postgresql.name:
+            conn_url = self.governor.postgresql.connection_string
+        if not conn_url:
+            return None
+        r = urlparse(conn_url)
+        return (r.hostname, r.port or 5432)
+
+    def follow(self, version=None, timeout=60):
+        state = self.governor.ha.watch(version, timeout)
+        target = state['leader'] and self.leader_address(state['leader'])
+        self.loop.call_soon_threadsafe(self.set_target, target)
+        return state['version']
+
+    def follow_leader(self):
+        version = None
+        while True:
+            version = self.follow(version)
+
+
+class EchoHandler(BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            data = self.request.recv(CHUNK_SIZE)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+class EchoServer(ThreadingMixIn, TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def measure(address, megabytes, round_trips):
+    """ returns the throughput in MB/s of data sent through an echo server and the average round trip in ms """
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        start = time.time()
+        for _ in range(round_trips):
+            sock.sendall(b'x')
+            sock.recv(1)
+        latency = (time.time() - start) * 1000 / round_trips
+
+        total = megabytes * 1048576
+
+        def send():
+            chunk = b'\0' * CHUNK_SIZE
+            for _ in range(total // CHUNK_SIZE):
+                sock.sendall(chunk)
+
+        sender = Thread(target=send)
+        start = time.time()
+        sender.start()
+        received = 0
+        while received < total:
+            data = sock.recv(CHUNK_SIZE)
+            if not data:
+                raise socket.error('connection closed after {} bytes'.format(received))
+            received += len(data)
+        sender.join()
+        return megabytes / (time.time() - start), latency
+    finally:
+        sock.close()
+
+
+def benchmark(args):
+    """ compares connections through the proxy with direct connections to an echo server """
+    echo = EchoServer(('127.0.0.1', 0), EchoHandler)
+    thread = Thread(target=echo.serve_forever)
+    thread.daemon = True
+    thread.start()
+    proxy = LeaderProxy(None, {'listen': '127.0.0.1:0'})
+    proxy.start_server()
+    proxy.target = echo.server_address
+    for method, address in (('direct', echo.server_address), ('proxy', proxy.address)):
+        throughput, latency = measure(address, args.megabytes, args.round_trips)
+        print('{:6} {:8.1f} MB/s {:8.3f} ms per round trip'.format(method, throughput, latency))
+    echo.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='leader following TCP proxy')
+    commands = parser.add_subparsers(dest='command')
+    parser_benchmark = commands.add_parser('benchmark', help='compare with direct connections')
+    parser_benchmark.add_argument('--megabytes', type=int, default=256)
+    parser_benchmark.add_argument('--round-trips', type=int, default=2000)
+    args = parser.parse_args()
+    if args.command == 'benchmark':
+        return benchmark(args)
+    parser.print_usage()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
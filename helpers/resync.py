@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import os
+import psycopg2
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# files and directory contents pg_basebackup doesn't copy either
+EXCLUDE_FILES = ('postmaster.pid', 'postmaster.opts', 'recovery.conf', 'recovery.done')
+EXCLUDE_DIRS = ('pg_xlog', 'pg_replslot', 'pg_stat_tmp', 'pg_dynshmem', 'pg_notify', 'pg_serial', 'pg_snapshots',
+                'pg_subtrans')
+
+FETCH_BATCH = 16  # number of chunks fetched with one query
+
+
+class Resync:
+    """ Brings a stale or diverged data directory up to date with the leader by copying only what differs.
+
+        All the work is done over a superuser connection to the leader, the same one pg_rewind uses: the leader
+        runs an exclusive backup, files with the same size and mtime as on the leader are skipped, for the rest
+        md5 checksums of every chunk are compared and only changed chunks are fetched with pg_read_binary_file.
+        Blocks modified after the backup start are fixed by WAL replay, just like after pg_basebackup. The WAL
+        from the backup start on is kept on the leader by the replication slot `slot_name`, which is created if
+        it is missing. """
+
+    def __init__(self, data_dir, conn_params, chunk_size=131072, slot_name=None):
+        self.data_dir = data_dir
+        self.conn_params = conn_params
+        self.chunk_size = chunk_size
+        self.slot_name = slot_name
+        self.cursor = None
+        self.stats = {'files': 0, 'files_copied': 0, 'bytes_total': 0, 'bytes_fetched': 0}
+
+    def ensure_slot(self):
+        self.cursor.execute("""SELECT current_setting('server_version_num')::integer >= 90600,
+                                      EXISTS (SELECT 1 FROM pg_replication_slots WHERE slot_name = %s)""",
+                            (self.slot_name,))
+        reserve, exists = self.cursor.fetchone()
+        if not exists:
+            # before 9.6 the slot only keeps WAL once the replica streamed from it
+            self.cursor.execute('SELECT pg_create_physical_replication_slot(%s{})'.format(', true' if reserve else ''),
+                                (self.slot_name,))
+
+    def list_files(self):
+        self.cursor.execute("""WITH RECURSIVE files(path, isdir) AS (
+                                   SELECT name, (pg_stat_file(name, true)).isdir FROM pg_ls_dir('.', true, false) name
+                               UNION ALL
+                                   SELECT f.path || '/' || name, (pg_stat_file(f.path || '/' || name, true)).isdir
+                                     FROM files f, pg_ls_dir(f.path, true, false) name
+                                    WHERE f.isdir AND NOT f.path = ANY(%s))
+                               SELECT path, (s).size, extract(epoch FROM (s).modification)::bigint, (s).isdir
+                                 FROM (SELECT path, pg_stat_file(path, true) s FROM files) f
+                                WHERE (s).size IS NOT NULL
+                                ORDER BY path""", (list(EXCLUDE_DIRS),))
+        return self.cursor.fetchall()
+
+    def remote_checksums(self, path, size):
+        self.cursor.execute("""SELECT md5(pg_read_binary_file(%s, o, %s, true))
+                                 FROM generate_series(0, %s - 1, %s) o ORDER BY o""",
+                            (path, self.chunk_size, size, self.chunk_size))
+        return [r[0] for r in self.cursor.fetchall()]
+
+    def local_checksums(self, local_path):
+        ret = []
+        with open(local_path, 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    return ret
+                ret.append(hashlib.md5(data).hexdigest())
+
+    def fetch(self, path, chunks):
+        for i in range(0, len(chunks), FETCH_BATCH):
+            offsets = [c * self.chunk_size for c in chunks[i:i + FETCH_BATCH]]
+            self.cursor.execute("SELECT o, pg_read_binary_file(%s, o, %s, true) FROM unnest(%s::bigint[]) o",
+                                (path, self.chunk_size, offsets))
+            for offset, data in self.cursor.fetchall():
+                yield offset, bytes(data or b'')
+
+    def sync_file(self, path, size, mtime):
+        local_path = os.path.join(self.data_dir, path)
+        chunks = list(range((size + self.chunk_size - 1) // self.chunk_size))
+        if os.path.isfile(local_path):
+            st = os.stat(local_path)
+            if st.st_size == size and int(st.st_mtime) == mtime:
+                return
+            local = self.local_checksums(local_path)
+            remote = self.remote_checksums(path, size)
+            chunks = [c for c in chunks if c >= len(local) or c >= len(remote) or local[c] != remote[c]]
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+
+        with open(local_path, mode) as f:
+            for offset, data in self.fetch(path, chunks):
+                f.seek(offset)
+                f.write(data)
+                self.stats['bytes_fetched'] += len(data)
+            f.truncate(size)
+        # with the leader's mtime the file will be skipped next time if neither side touches it
+        os.utime(local_path, (mtime, mtime))
+        self.stats['files_copied'] += 1
+
+    def sync(self):
+        seen = set()
+        for path, size, mtime, isdir in self.list_files():
+            seen.add(path)
+            local_path = os.path.join(self.data_dir, path)
+            if isdir:
+                if not os.path.isdir(local_path):
+                    os.makedirs(local_path)
+            elif path not in EXCLUDE_FILES:
+                self.stats['files'] += 1
+                self.stats['bytes_total'] += size
+                self.sync_file(path, size, mtime)
+        self.remove_extra_files(seen)
+
+    def remove_extra_files(self, seen):
+        for root, dirs, files in os.walk(self.data_dir, topdown=False):
+            for name in files + dirs:
+                local_path = os.path.join(root, name)
+                path = os.path.relpath(local_path, self.data_dir)
+                if path in seen or path in EXCLUDE_FILES or os.path.islink(local_path):
+                    continue
+                if os.path.isdir(local_path):
+                    shutil.rmtree(local_path)
+                else:
+                    os.unlink(local_path)
+
+    def run(self):
+        start = time.time()
+        params = dict(self.conn_params, options='-c statement_timeout=0')
+        conn = psycopg2.connect(**params)
+        try:
+            conn.autocommit = True
+            self.cursor = conn.cursor()
+            self.slot_name and self.ensure_slot()
+            self.cursor.execute("SELECT pg_start_backup('governor resync', true)")
+            try:
+                self.sync()
+            finally:
+                self.cursor.execute('SELECT pg_stop_backup()')
+        finally:
+            conn.close()
+
+        self.stats['bytes_saved'] = self.stats['bytes_total'] - self.stats['bytes_fetched']
+        self.stats['duration'] = round(time.time() - start, 3)
+        logger.info('resync: fetched %s of %s bytes in %s files, saved %s bytes', self.stats['bytes_fetched'],
+                    self.stats['bytes_total'], self.stats['files_copied'], self.stats['bytes_saved'])
+        return self.stats
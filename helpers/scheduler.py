@@ -0,0 +1,88 @@
+import logging
+import time
+import zlib
+
+from helpers.utils import wait
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """ Adaptive interval between two runs of the HA loop.
+
+        `loop_wait` is the upper bound and the interval used while the cluster is steady, `min_loop_wait` is used
+        right after something interesting happened. After every steady cycle the interval is doubled until it
+        reaches `loop_wait` again. Since the interval never exceeds `loop_wait` the `ttl > 2 * loop_wait` invariant
+        still holds.
+
+        Runs are aligned to a per-node phase derived from `seed`, so nodes started at the same moment don't hit
+        etcd at the same moment for the rest of their lives. """
+
+    def __init__(self, config, seed=''):
+        self.max_interval = config['loop_wait']
+        self.min_interval = min(config.get('min_loop_wait', self.max_interval), self.max_interval)
+        if self.min_interval <= 0:  # the runs would neither be spaced nor aligned
+            raise ValueError('loop_wait and min_loop_wait must be positive')
+        self.interval = self.max_interval
+        self.phase = self.phase_offset(seed, self.max_interval)
+        self.next_run = time.time()
+
+    @staticmethod
+    def phase_offset(seed, interval):
+        """
+        >>> Scheduler.phase_offset('batman/postgresql0', 10) == Scheduler.phase_offset('batman/postgresql0', 10)
+        True
+        >>> 0 <= Scheduler.phase_offset('batman/postgresql1', 10) < 10
+        True
+        """
+        return (zlib.crc32(seed.encode('utf-8')) & 0xffffffff) * interval / float(0x100000000)
+
+    def align(self, value):
+        """ returns the last point in time before `value` which is in phase with this node """
+        return value - (value - self.phase) % self.interval
+
+    def reset(self):
+        self.next_run = self.align(time.time())
+
+    def tighten(self):
+        if self.interval > self.min_interval:
+            logger.info('Shortening loop interval to %s seconds', self.min_interval)
+        self.interval = self.min_interval
+
+    def relax(self):
+        self.interval = min(self.interval * 2, self.max_interval)
+
+    def update(self, stable, leader_ttl=None):
+        """
+        >>> s = Scheduler({'loop_wait': 10, 'min_loop_wait': 1})
+        >>> s.update(False)
+        1
+        >>> s.update(True)
+        2
+        >>> s.update(True, 30)
+        4
+        >>> s.update(True, 5)
+        1
+        >>> for _ in range(4): _ = s.update(True)
+        >>> s.interval
+        10
+        """
+        # the lock is about to expire, we want to notice this as early as possible
+        if not stable or (leader_ttl is not None and leader_ttl <= self.max_interval):
+            self.tighten()
+        else:
+            self.relax()
+        return self.interval
+
+    def schedule_next_run(self, postmaster_pid=None):
+        """ sleeps until the next run, returns early if the postmaster dies or somebody requested a wakeup """
+        self.next_run += self.interval
+        current_time = time.time()
+        nap_time = self.next_run - current_time
+        if nap_time <= 0:
+            self.next_run = self.align(current_time)
+        else:
+            reason = wait(nap_time, postmaster_pid)
+            if reason != 'timeout':
+                logger.info('Woke up early: %s', 'postmaster has exited' if reason == 'exited' else 'wakeup requested')
+                self.next_run = self.align(time.time())
@@ -0,0 +1,198 @@
+import logging
+import psycopg2
+import requests
+import time
+
+from helpers.errors import EtcdError, SwitchoverError
+from helpers.postgresql import query_member
+from helpers.utils import api_base_url, lsn_to_bytes, sleep
+from requests.exceptions import RequestException
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1
+XLOG_BLCKSZ = 8192
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+# XLogRecord, the short data header and the CheckPoint struct of the shutdown checkpoint record, MAXALIGNed
+CHECKPOINT_RECORD_SIZE = 112
+
+
+def checkpoint_record_end(location):
+    """ the end of the shutdown checkpoint record starting at `location`, a record crossing a page boundary
+        continues after the header of the next page (a long one at the start of a segment)
+
+    >>> checkpoint_record_end(0x3000028)
+    50331800
+    >>> checkpoint_record_end(0x3001FC8) - 0x3001FC8
+    136
+    >>> checkpoint_record_end(0x3FFFFC8) - 0x3FFFFC8
+    152
+    """
+    position, remaining = location, CHECKPOINT_RECORD_SIZE
+    while remaining > XLOG_BLCKSZ - position % XLOG_BLCKSZ:
+        remaining -= XLOG_BLCKSZ - position % XLOG_BLCKSZ
+        position += XLOG_BLCKSZ - position % XLOG_BLCKSZ
+        position += 40 if position % WAL_SEGMENT_SIZE == 0 else 24
+    return position + remaining
+
+
+class Switchover:
+    """ Planned move of the leader role to another member.
+
+        Every phase must finish before the common deadline. Until the local postgres is stopped an error leaves
+        the cluster untouched, if the target doesn't receive the final WAL in time the local postgres is started
+        again as a master. """
+
+    def __init__(self, ha, member=None, timeout=None):
+        self.ha = ha
+        self.state_handler = ha.state_handler
+        self.etcd = ha.etcd
+        self.member = member
+        self.timeout = timeout or self.etcd.ttl
+        self.deadline = None
+        self.lock_expires = None
+        self.stopped = False
+        self.target = None
+        self.phases = []
+
+    def time_left(self):
+        """ nothing may run longer than the leader lock, the HA loop doesn't renew it meanwhile """
+        return min(self.deadline, self.lock_expires) - time.time()
+
+    def renew_lock(self, force=False):
+        """ renews the leader lock while postgres is running, at the latest when half of the ttl is over """
+        if self.stopped or not force and self.lock_expires - time.time() > self.etcd.ttl / 2.0:
+            return
+        now = time.time()
+        if not self.ha.update_lock():
+            raise SwitchoverError('failed to update the leader lock')
+        self.lock_expires = now + self.etcd.ttl
+
+    def lock_is_ours(self):
+        try:
+            self.ha.load_cluster_from_etcd()
+            return self.ha.has_lock()
+        except EtcdError:
+            return False
+
+    def phase(self, name, func, *args):
+        self.renew_lock()
+        if self.time_left() <= 0:
+            raise SwitchoverError('timed out before ' + name)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.phases.append({'name': name, 'duration': round(time.time() - start, 3)})
+            logger.info('switchover: %s took %s seconds', name, self.phases[-1]['duration'])
+
+    def poll(self, name, check):
+        while True:
+            try:
+                if check():
+                    return
+            except psycopg2.Error as e:
+                logger.debug('switchover: %s', e)
+            self.renew_lock()
+            if self.time_left() <= 0:
+                raise SwitchoverError('timed out waiting for ' + name)
+            sleep(POLL_INTERVAL)
+
+    def member_positions(self, member):
+        """ returns (in_recovery, received, replayed) WAL positions of the member in bytes """
+        row = query_member(member.conn_url, """SELECT pg_is_in_recovery(),
+                                                      pg_last_xlog_receive_location() - '0/0'::pg_lsn,
+                                                      pg_last_xlog_replay_location() - '0/0'::pg_lsn""")
+        return row[0], int(row[1] or 0), int(row[2] or 0)
+
+    def choose_target(self):
+        candidates = [m for m in self.ha.cluster.members if m.hostname != self.state_handler.name and m.conn_url]
+        if self.member:
+            candidates = [m for m in candidates if m.hostname == self.member]
+            if not candidates:
+                raise SwitchoverError('member {} is not known'.format(self.member))
+
+        best = None
+        for member in candidates:
+            try:
+                in_recovery, _, replayed = self.member_positions(member)
+            except psycopg2.Error:
+                logger.exception('switchover: can not query %s', member.hostname)
+                continue
+            if in_recovery and (not best or replayed > best[1]):
+                best = (member, replayed)
+        if not best:
+            raise SwitchoverError('no healthy replica to switch over to')
+        return best[0]
+
+    def wait_for_catchup(self):
+        max_lag = self.state_handler.config.get('maximum_lag_on_failover', 0)
+
+        def caught_up():
+            return self.state_handler.xlog_position() - self.member_positions(self.target)[2] <= max_lag
+        self.poll('replica to catch up', caught_up)
+
+    def stop(self):
+        # renew the lock, from now on nobody will do it until the target holds it
+        self.renew_lock(True)
+        if self.state_handler.stop():
+            raise SwitchoverError('failed to stop postgresql')
+        self.stopped = True
+
+    def wait_for_final_wal(self):
+        location = lsn_to_bytes(self.state_handler.controldata().get('Latest checkpoint location', ''))
+        if not location:
+            raise SwitchoverError('can not read the shutdown checkpoint location')
+        # the target has the whole checkpoint record only when it received everything up to its end
+        end = checkpoint_record_end(location)
+        self.poll('the shutdown checkpoint', lambda: self.member_positions(self.target)[1] >= end)
+
+    def handover(self):
+        if not self.etcd.switch_leader(self.state_handler.name, self.target.hostname):
+            raise SwitchoverError('failed to hand over the leader lock')
+        # the target would promote itself on its next loop run, ask it to run the loop right now
+        if self.target.api_url:
+            try:
+                requests.post(api_base_url(self.target.api_url) + '/wakeup', timeout=1)
+            except RequestException:
+                logger.warning('switchover: could not wake up %s', self.target.hostname)
+
+    def wait_for_promotion(self):
+        self.poll('replica to promote', lambda: not self.member_positions(self.target)[0])
+
+    def run(self):
+        start = time.time()
+        self.deadline = start + self.timeout
+        self.lock_expires = start  # renewed before the first phase
+        self.ha.load_cluster_from_etcd()
+        if not self.ha.has_lock() or not self.state_handler.is_leader():
+            raise SwitchoverError('i am not the leader')
+
+        report = {'from': self.state_handler.name, 'phases': self.phases, 'success': False}
+        handed_over = False
+        try:
+            self.target = self.phase('choose_target', self.choose_target)
+            report['to'] = self.target.hostname
+            self.phase('checkpoint', self.state_handler.checkpoint)
+            self.phase('catchup', self.wait_for_catchup)
+            self.phase('stop', self.stop)
+            self.phase('final_wal', self.wait_for_final_wal)
+            self.phase('handover', self.handover)
+            handed_over = True
+            self.phase('promote', self.wait_for_promotion)
+            report['success'] = True
+        except SwitchoverError as e:
+            report['error'] = e.value
+        except psycopg2.Error as e:
+            report['error'] = str(e).strip()
+
+        if not report['success']:
+            logger.error('switchover failed: %s', report['error'])
+            if self.stopped and not handed_over:
+                # the target didn't get everything, the data is safe here as long as nobody took the lock
+                if self.lock_is_ours():
+                    self.state_handler.start()
+                else:
+                    logger.error('switchover: lost the leader lock, leaving postgresql stopped for the HA loop')
+        report['duration'] = round(time.time() - start, 3)
+        return report
@@ -1,9 +1,26 @@
+import errno
+import fcntl
 import os
+import select
 import signal
 import sys
 import time
 
+if sys.hexversion >= 0x03000000:
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
 received_sigchld = False
+received_sighup = False
+watched_pid = None  # pid `wait` is waiting for, when it is our child sigchld_handler could reap it
+watched_pid_reaped = False
+
+# read ends of the pipes `wait` is listening on, signal handlers write to the first one, `wakeup` to the second one
+_signal_pipe = None
+_wakeup_pipe = None
+
+PID_POLL_INTERVAL = 0.1  # how often we check the pid when pidfd_open is not available
 
 
 def lsn_to_bytes(value):
@@ -32,18 +49,60 @@ def bytes_to_lsn(value):
     return '%x/%x' % (id, off)
 
 
+def segment_to_bytes(name):
+    """ returns the WAL position where the segment with given file name starts
+
+    >>> segment_to_bytes('000000010000000100000066')
+    6006243328
+    """
+    return (int(name[8:16], 16) << 32) | (int(name[16:24], 16) << 24)
+
+
+def segments_to_positions(names):
+    """ returns (timeline, start position) for every WAL segment file name, suffixes are ignored
+
+    >>> segments_to_positions(['000000010000000100000066', '00000002000000000000000A.partial'])
+    [(1, 6006243328), (2, 167772160)]
+    """
+    return [(int(name[:8], 16), (int(name[8:16], 16) << 32) | (int(name[16:24], 16) << 24)) for name in names]
+
+
+def api_base_url(api_url):
+    """
+    >>> api_base_url('http://127.0.0.1:8008/governor')
+    'http://127.0.0.1:8008'
+    """
+    r = urlparse(api_url)
+    return '{}://{}'.format(r.scheme, r.netloc)
+
+
 def sigterm_handler(signo, stack_frame):
     sys.exit()
 
 
+def sighup_handler(signo, stack_frame):
+    global received_sighup
+    received_sighup = True
+    wakeup()
+
+
+def reload_requested():
+    """ returns True once after every SIGHUP """
+    global received_sighup
+    ret, received_sighup = received_sighup, False
+    return ret
+
+
 def sigchld_handler(signo, stack_frame):
-    global received_sigchld
+    global received_sigchld, watched_pid_reaped
     received_sigchld = True
     try:
         while True:
             ret = os.waitpid(-1, os.WNOHANG)
             if ret == (0, 0):
                 break
+            if ret[0] == watched_pid:
+                watched_pid_reaped = True
     except OSError:
         pass
 
@@ -61,6 +120,106 @@ def sleep(interval):
     received_sigchld = False
 
 
+def _nonblocking_pipe():
+    pipe = os.pipe()
+    for fd in pipe:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return pipe
+
+
+def _drain(fd):
+    try:
+        while os.read(fd, 512):
+            pass
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+def pid_exists(pid):
+    if pid == watched_pid and watched_pid_reaped:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _open_pidfd(pid):
+    """ pidfd becomes readable as soon as the process exits, it works for processes which are not our children """
+    if hasattr(os, 'pidfd_open'):
+        try:
+            return os.pidfd_open(pid)
+        except OSError:
+            pass
+
+
+def wakeup():
+    """ interrupts `wait` in the main thread, safe to call from any thread """
+    if _wakeup_pipe:
+        try:
+            os.write(_wakeup_pipe[1], b'\0')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+def wait(interval, pid=None):
+    """ Sleeps for `interval` seconds like `sleep` does, but returns early when the process with given `pid`
+        (our postmaster) exits or somebody calls `wakeup`. Signals and exits of other children are ignored.
+        Returns 'timeout', 'exited' or 'wakeup'. """
+    global watched_pid, watched_pid_reaped
+
+    if pid != watched_pid:
+        watched_pid, watched_pid_reaped = pid, False
+
+    # don't watch a process which is already gone, otherwise we would never sleep
+    if pid and (pid == os.getpid() or not pid_exists(pid)):
+        pid = None
+    pidfd = pid and _open_pidfd(pid)
+
+    fds = [p[0] for p in (_signal_pipe, _wakeup_pipe) if p] + ([pidfd] if pidfd else [])
+    if not fds and not pid:
+        sleep(interval)
+        return 'timeout'
+
+    end_time = time.time() + interval
+    try:
+        while True:
+            if pid and not pidfd and not pid_exists(pid):
+                return 'exited'
+
+            timeout = end_time - time.time()
+            if timeout <= 0:
+                return 'timeout'
+            if pid and not pidfd:
+                timeout = min(timeout, PID_POLL_INTERVAL)
+
+            try:
+                ready = select.select(fds, [], [], timeout)[0]
+            except (OSError, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            if pidfd and pidfd in ready:
+                return 'exited'
+            if _wakeup_pipe and _wakeup_pipe[0] in ready:
+                _drain(_wakeup_pipe[0])
+                return 'wakeup'
+            if _signal_pipe and _signal_pipe[0] in ready:
+                _drain(_signal_pipe[0])  # the handler has already done its job
+    finally:
+        pidfd and os.close(pidfd)
+
+
 def setup_signal_handlers():
+    global _signal_pipe, _wakeup_pipe
     signal.signal(signal.SIGTERM, sigterm_handler)
     signal.signal(signal.SIGCHLD, sigchld_handler)
+    signal.signal(signal.SIGHUP, sighup_handler)
+    if not _signal_pipe:
+        _signal_pipe = _nonblocking_pipe()
+        _wakeup_pipe = _nonblocking_pipe()
+    signal.set_wakeup_fd(_signal_pipe[1])
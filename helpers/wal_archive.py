@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+""" WAL archiving with a pool of worker threads running inside governor.
+
+    The archive_command (`wal_archive.py push %f`) hands the segment to governor over the REST API and waits until
+    it is archived. If governor can't be reached the segment is archived by the command itself.
+
+    usage: wal_archive.py push --archive-dir DIR [--api-url URL] [--compression gzip|lzma|none] %f
+           wal_archive.py benchmark [--segments N] [--workers N]
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from threading import Event, Lock, Thread
+
+try:
+    import lzma
+except ImportError:  # python 2
+    lzma = None
+
+if sys.hexversion >= 0x03000000:
+    from queue import Queue
+    from urllib.error import URLError
+    from urllib.request import Request, urlopen
+else:
+    from Queue import Queue
+    from urllib2 import Request, URLError, urlopen
+
+logger = logging.getLogger(__name__)
+
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_RE = re.compile(r'^[0-9A-F]{24}$')
+WAL_NAME_RE = re.compile(r'^([0-9A-F]{24}(\.partial|\.[0-9A-F]{8}\.backup)?|[0-9A-F]{8}\.history)$')
+SUFFIXES = {'gzip': '.gz', 'lzma': '.xz', 'none': ''}
+CHUNK_SIZE = 1048576
+
+
+def compressed_writer(f, compression, level=None):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6 if level is None else level)
+    if compression == 'lzma':
+        return lzma.LZMAFile(f, 'wb', preset=level)
+    return None
+
+
+def compressed_reader(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'lzma':
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def same_content(f1, f2):
+    while True:
+        chunk = f1.read(CHUNK_SIZE)
+        if chunk != f2.read(CHUNK_SIZE):
+            return False
+        if not chunk:
+            return True
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WalArchiver:
+    """ Compresses WAL files into the archive directory.
+
+        Postgres archives one file at a time and waits for every archive_command. When asked for one we also take
+        the other files postgres has already marked as ready. They are compressed in parallel by the workers, the
+        requests for them which follow return immediately. Every file is fsynced by its worker, the archive
+        directory only once per batch. """
+
+    def __init__(self, data_dir, archive_dir, compression='gzip', level=None, workers=4):
+        if compression not in SUFFIXES or compression == 'lzma' and not lzma:
+            raise ValueError('unsupported compression: {}'.format(compression))
+        self.xlog_dir = os.path.join(data_dir, 'pg_xlog')
+        self.status_dir = os.path.join(self.xlog_dir, 'archive_status')
+        self.archive_dir = archive_dir
+        self.compression = compression
+        self.level = level
+        self.workers = max(workers, 1)
+        self.queue = Queue()
+        self.threads = []
+        self.lock = Lock()
+        self.archived = set()
+        self.last_archived = None
+        self.last_archived_time = None
+        self.failed = 0
+        self.bytes_in = self.bytes_out = 0
+        self.on_archived = None  # called with the names of the files in the archive directory after every batch
+
+    def start(self):
+        """ starts the worker pool, without it everything is archived by the calling thread """
+        while len(self.threads) < self.workers:
+            thread = Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            self.run_job(self.queue.get())
+
+    def target(self, name):
+        return os.path.join(self.archive_dir, name + SUFFIXES[self.compression])
+
+    def check_archived(self, job):
+        """ A file which is archived already may only be archived again with the same content, e.g. when
+            postgres crashed before it noticed that the archive_command succeeded. A different file with the same
+            name comes from a diverged timeline and must never replace the archived one. """
+        try:
+            with compressed_reader(self.target(job['name']), self.compression) as archived:
+                with open(os.path.join(self.xlog_dir, job['name']), 'rb') as src:
+                    job['ok'] = same_content(archived, src)
+        except (IOError, OSError, EOFError) as e:
+            job['error'] = str(e)
+            return
+        if not job['ok']:
+            job['error'] = 'a different file is archived as ' + job['name']
+            logger.error(job['error'])
+
+    def run_job(self, job):
+        if os.path.exists(self.target(job['name'])):
+            job['existing'] = True
+            self.check_archived(job)
+            return job['done'].set()
+
+        tmp = self.target(job['name']) + '.tmp'
+        try:
+            with open(os.path.join(self.xlog_dir, job['name']), 'rb') as src:
+                with open(tmp, 'wb') as f:
+                    dst = compressed_writer(f, self.compression, self.level) or f
+                    while True:
+                        chunk = src.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        job['size'] += len(chunk)
+                    if dst is not f:
+                        dst.close()
+                    f.flush()
+                    os.fsync(f.fileno())
+            job['ok'] = True
+        except (IOError, OSError) as e:
+            job['error'] = str(e)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        job['done'].set()
+
+    def submit(self, name):
+        job = {'name': name, 'done': Event(), 'ok': False, 'size': 0, 'existing': False}
+        if self.threads:
+            self.queue.put(job)
+        else:
+            self.run_job(job)
+        return job
+
+    def ready(self):
+        """ files postgres wants to have archived """
+        try:
+            return sorted(f[:-6] for f in os.listdir(self.status_dir) if f.endswith('.ready'))
+        except OSError:
+            return []
+
+    def archive(self, name):
+        if not WAL_NAME_RE.match(name):
+            raise ValueError('not a WAL file name: {}'.format(name))
+
+        with self.lock:
+            if name in self.archived:
+                self.archived.discard(name)
+                return True
+            # everything older was requested and archived already
+            self.archived = set(n for n in self.archived if n > name)
+
+            if not os.path.isdir(self.archive_dir):
+                os.makedirs(self.archive_dir)
+            batch = [name] + [n for n in self.ready() if n != name and n not in self.archived][:self.workers - 1]
+            jobs = [self.submit(n) for n in batch]
+            for job in jobs:
+                job['done'].wait()
+
+            done = [job for job in jobs if job['ok']]
+            for job in done:
+                if job['existing']:
+                    continue
+                os.rename(self.target(job['name']) + '.tmp', self.target(job['name']))
+                self.bytes_in += job['size']
+                self.bytes_out += os.path.getsize(self.target(job['name']))
+            if done:
+                fsync_dir(self.archive_dir)
+                self.last_archived = max(job['name'] for job in done)
+                self.last_archived_time = time.time()
+                if self.on_archived:
+                    self.on_archived([os.path.basename(self.target(job['name'])) for job in done])
+            self.failed += len(jobs) - len(done)
+            self.archived.update(job['name'] for job in done if job['name'] != name)
+            return jobs[0]['ok']
+
+    def status(self):
+        ready = self.ready()
+        try:
+            oldest = min(os.path.getmtime(os.path.join(self.status_dir, n + '.ready')) for n in ready)
+        except (OSError, ValueError):
+            oldest = None
+        pending_bytes = 0
+        for name in ready:
+            try:  # history and backup history files are tiny
+                pending_bytes += WAL_SEGMENT_SIZE if SEGMENT_RE.match(name) else \
+                    os.path.getsize(os.path.join(self.xlog_dir, name))
+            except OSError:
+                pass
+        return {
+            'pending': len(ready),
+            'pending_bytes': pending_bytes,
+            'lag_seconds': int(time.time() - oldest) if oldest else 0,
+            'last_archived': self.last_archived,
+            'last_archived_time': self.last_archived_time and int(self.last_archived_time),
+            'failed': self.failed,
+            'compression': self.compression,
+            'compression_ratio': round(float(self.bytes_out) / self.bytes_in, 3) if self.bytes_in else None
+        }
+
+
+def push(args):
+    if args.api_url:
+        request = Request(args.api_url + '/archive', json.dumps({'name': args.name}).encode('utf-8'),
+                          {'Content-Type': 'application/json'})
+        try:
+            return 0 if urlopen(request, timeout=args.timeout).getcode() == 200 else 1
+        except URLError as e:
+            if hasattr(e, 'code'):  # governor tried and failed
+                return 1
+            sys.stderr.write('governor is not reachable, archiving {} directly\n'.format(args.name))
+    archiver = WalArchiver(args.data_dir, args.archive_dir, args.compression, args.level, 1)
+    return 0 if archiver.archive(args.name) else 1
+
+
+def make_segments(directory, count):
+    """ segments half filled with incompressible data, like WAL of a busy cluster """
+    os.makedirs(os.path.join(directory, 'pg_xlog', 'archive_status'))
+    names = ['0000000100000001{:08X}'.format(i) for i in range(count)]
+    for name in names:
+        with open(os.path.join(directory, 'pg_xlog', name), 'wb') as f:
+            for _ in range(WAL_SEGMENT_SIZE // 16384):
+                f.write(os.urandom(4096) + b'governor' * 1536)
+        open(os.path.join(directory, 'pg_xlog', 'archive_status', name + '.ready'), 'w').close()
+    return names
+
+
+def benchmark(args):
+    """ compares `cp` run for every segment, like the shipped archive_command, with the worker pool """
+    directory = tempfile.mkdtemp()
+    try:
+        names = make_segments(directory, args.segments)
+        xlog_dir = os.path.join(directory, 'pg_xlog')
+        archive_dir = os.path.join(directory, 'cp')
+        os.makedirs(archive_dir)
+        start = time.time()
+        for name in names:
+            subprocess.call('cp {0}/{1} {2}/{1}'.format(xlog_dir, name, archive_dir), shell=True)
+        results = [('cp', time.time() - start, 1.0)]
+
+        for compression in ('none', 'gzip', 'lzma'):
+            if compression == 'lzma' and not lzma:
+                continue
+            archiver = WalArchiver(directory, os.path.join(directory, compression), compression, 1, args.workers)
+            archiver.start()
+            start = time.time()
+            for name in names:
+                # postgres calls the archive_command for one file at a time and marks it as done afterwards
+                archiver.archive(name)
+                os.rename(os.path.join(archiver.status_dir, name + '.ready'),
+                          os.path.join(archiver.status_dir, name + '.done'))
+            results.append((compression, time.time() - start, archiver.status()['compression_ratio']))
+            for name in names:
+                os.rename(os.path.join(archiver.status_dir, name + '.done'),
+                          os.path.join(archiver.status_dir, name + '.ready'))
+    finally:
+        shutil.rmtree(directory)
+
+    size = args.segments * WAL_SEGMENT_SIZE / 1048576.0
+    for method, duration, ratio in results:
+        print('{:5} {:8.2f}s {:8.1f} MB/s  ratio {}'.format(method, duration, size / duration, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WAL archiving through governor')
+    commands = parser.add_subparsers(dest='command')
+    parser_push = commands.add_parser('push', help='archive_command')
+    parser_push.add_argument('--api-url', help='base url of the governor REST API')
+    parser_push.add_argument('--data-dir', default='.', help='the archive_command runs in the data directory')
+    parser_push.add_argument('--archive-dir', required=True)
+    parser_push.add_argument('--compression', choices=sorted(SUFFIXES), default='gzip')
+    parser_push.add_argument('--level', type=int)
+    parser_push.add_argument('--timeout', type=int, default=600)
+    parser_push.add_argument('name', help='%%f')
+    parser_benchmark = commands.add_parser('benchmark', help='compare with cp')
+    parser_benchmark.add_argument('--segments', type=int, default=32)
+    parser_benchmark.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    if args.command == 'benchmark':
+        return benchmark(args)
+    return push(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import gzip
+import logging
+import os
+import re
+import time
+
+from helpers.utils import bytes_to_lsn, segment_to_bytes, segments_to_positions
+from threading import Lock
+
+try:
+    from os import scandir
+except ImportError:  # python 2
+    scandir = None
+
+try:
+    import lzma
+except ImportError:  # python 2
+    lzma = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = '.governor_index'
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+# history files are tiny and needed to follow timeline switches, they are never removed
+WAL_FILE_RE = re.compile(r'^[0-9A-F]{24}(\.partial|\.[0-9A-F]{8}\.backup)?(\.gz|\.xz)?$')
+# the labels of the backups governor takes itself: pg_basebackup clones and delta resyncs, they are no base backups
+GOVERNOR_LABELS = ('governor clone', 'governor resync')
+
+
+def list_wal_files(directory):
+    if scandir:
+        return [e.name for e in scandir(directory) if WAL_FILE_RE.match(e.name) and e.is_file()]
+    return [name for name in os.listdir(directory) if WAL_FILE_RE.match(name)]
+
+
+def backup_start(name):
+    """ the timeline and the position where the base backup described by the backup history file starts
+
+    >>> backup_start('000000010000000000000002.00000028.backup.gz')
+    (1, 33554472)
+    """
+    return int(name[:8], 16), segment_to_bytes(name[:24]) + int(name[25:33], 16)
+
+
+def backup_label(path):
+    """ the label of the backup from its history file, None if it can't be read """
+    opener = {'.gz': gzip.open, '.xz': lzma and lzma.open}.get(path[-3:], open)
+    try:
+        f = opener(path, 'rb')
+        try:
+            for line in f.read().decode('utf-8', 'replace').splitlines():
+                if line.startswith('LABEL: '):
+                    return line[7:].strip()
+        finally:
+            f.close()
+    except Exception:  # a truncated or foreign file, it proves no base backup
+        pass
+    return None
+
+
+class WalIndex:
+    """ The WAL files in an archive directory.
+
+        Listing a directory with millions of files takes a while, so the names are kept in `INDEX_FILE`. The
+        archiver appends every file it archived, the directory is listed again only when the index is missing or
+        was built more than `rescan_interval` seconds ago, in case something else writes into the archive too. """
+
+    def __init__(self, archive_dir, rescan_interval=86400):
+        self.archive_dir = archive_dir
+        self.path = os.path.join(archive_dir, INDEX_FILE)
+        self.rescan_interval = rescan_interval
+        self.lock = Lock()
+
+    def append(self, names):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(''.join(name + '\n' for name in names))
+
+    def write(self, names, scanned):
+        with open(self.path + '.tmp', 'w') as f:
+            f.write('# scanned {}\n'.format(scanned))
+            f.write(''.join(name + '\n' for name in names))
+        os.rename(self.path + '.tmp', self.path)
+
+    def load(self):
+        """ returns the time the directory was listed and the names of the files """
+        try:
+            with open(self.path) as f:
+                header = f.readline().split()
+                if len(header) == 3 and header[:2] == ['#', 'scanned'] and \
+                        time.time() - float(header[2]) < self.rescan_interval:
+                    return float(header[2]), set(line.strip() for line in f if line.strip())
+        except (IOError, OSError, ValueError):
+            pass
+
+        scanned = time.time()
+        names = list_wal_files(self.archive_dir)
+        self.write(names, scanned)
+        logger.info('indexed %s files in %s', len(names), self.archive_dir)
+        return scanned, set(names)
+
+    def cleanup(self, keep_backups, min_position=None):
+        """ Removes the segments which end before the start of the `keep_backups` newest base backups and before
+            `min_position`. Nothing is removed as long as there is no base backup in the archive.
+
+            Base backups are found through their backup history files, the ones governor took itself to clone or
+            resync a member don't count (see `GOVERNOR_LABELS`). A backup on a later timeline is newer than any
+            backup on an earlier one, the WAL of all kept backups is kept whatever their timeline is.
+
+            Returns the number of removed files. """
+        with self.lock:
+            _, names = self.load()
+        backups = sorted(backup_start(name) for name in names if '.backup' in name and
+                         backup_label(os.path.join(self.archive_dir, name)) not in GOVERNOR_LABELS + (None,))
+        if not backups:
+            return 0
+        cutoff = min(start for _, start in backups[-max(keep_backups, 1):])
+        if min_position is not None:
+            cutoff = min(cutoff, min_position)
+
+        names = sorted(names)
+        remove = [name for name, (_, position) in zip(names, segments_to_positions(names))
+                  if '.backup' in name and backup_start(name)[1] < cutoff or position + WAL_SEGMENT_SIZE <= cutoff]
+        if not remove:
+            return 0
+
+        # the archiver appends to the index meanwhile, it must not wait for the files to be removed
+        for name in remove:
+            try:
+                os.unlink(os.path.join(self.archive_dir, name))
+            except OSError:  # removed by somebody else
+                pass
+
+        with self.lock:
+            scanned, names = self.load()
+            self.write(sorted(names.difference(remove)), scanned)
+        logger.info('removed %s files older than %s from %s', len(remove), bytes_to_lsn(cutoff),
+                    self.archive_dir)
+        return len(remove)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+""" restore_command fetching the following WAL segments in parallel into a spool directory.
+
+    Postgres asks for one segment at a time, so catching up from the archive is dominated by the latency of every
+    single fetch. When a segment is not in the spool yet, it is fetched together with up to `--prefetch` following
+    ones; the next requests are answered from the spool. Segments older than the requested one are removed and the
+    spool never grows beyond `--max-spool-size` bytes. Once a segment was missing in the archive nothing is
+    prefetched until it was fetched, a standby polling the end of the archive fetches one segment at a time.
+
+    usage: wal_restore.py (--archive-dir DIR | --wal-e-env-dir DIR) --spool-dir DIR [--prefetch N] %f %p
+"""
+import argparse
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+from threading import Thread
+
+try:
+    import lzma
+except ImportError:  # python 2
+    lzma = None
+
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_RE = re.compile('^[0-9A-F]{24}$')
+MISSING = 'missing'  # holds the first segment which was not in the archive
+
+
+def next_segments(name, count):
+    """
+    >>> next_segments('0000000100000001000000FE', 3)
+    ['0000000100000001000000FF', '000000010000000200000000', '000000010000000200000001']
+    >>> next_segments('00000002.history', 3)
+    []
+    """
+    if not SEGMENT_RE.match(name):
+        return []
+    log, seg = int(name[8:16], 16), int(name[16:24], 16)
+    ret = []
+    for _ in range(count):
+        seg += 1
+        if seg > 0xFF:
+            log, seg = log + 1, 0
+        ret.append('{}{:08X}{:08X}'.format(name[:8], log, seg))
+    return ret
+
+
+def archive_dir_fetch(directory):
+    """ fetches from a directory, e.g. the one the archive_command copies to. Files compressed by wal_archive.py
+        are decompressed. """
+    def fetch(name, path):
+        source = os.path.join(directory, name)
+        if os.path.isfile(source):
+            shutil.copyfile(source, path)
+            return True
+        for suffix, module in (('.gz', gzip), ('.xz', lzma)):
+            if module and os.path.isfile(source + suffix):
+                src = module.open(source + suffix, 'rb')
+                try:
+                    with open(path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                finally:
+                    src.close()
+                return True
+        return False
+    return fetch
+
+
+def wal_e_fetch(env_dir):
+    def fetch(name, path):
+        return subprocess.call(['envdir', env_dir, 'wal-e', '--aws-instance-profile', 'wal-fetch', name, path]) == 0
+    return fetch
+
+
+class WalRestore:
+
+    def __init__(self, fetch, spool_dir, prefetch=8, max_spool_size=None):
+        self.fetch = fetch
+        self.spool_dir = spool_dir
+        self.prefetch = prefetch
+        self.misses = []
+        self.max_spool_size = prefetch * WAL_SEGMENT_SIZE if max_spool_size is None else max_spool_size
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
+    def spool_path(self, name):
+        return os.path.join(self.spool_dir, name)
+
+    def clean_spool(self, name):
+        """ postgres asks for segments in order, the older ones were already replayed. History files are asked
+            for in between, they tell nothing about the segments. """
+        if not SEGMENT_RE.match(name):
+            return
+        for f in os.listdir(self.spool_dir):
+            if f.endswith('.tmp') or SEGMENT_RE.match(f) and f < name:
+                os.unlink(self.spool_path(f))
+
+    def missing(self):
+        try:
+            with open(self.spool_path(MISSING)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def set_missing(self, name):
+        if name:
+            with open(self.spool_path(MISSING), 'w') as f:
+                f.write(name)
+        elif os.path.exists(self.spool_path(MISSING)):
+            os.unlink(self.spool_path(MISSING))
+
+    def spool_size(self):
+        return sum(os.path.getsize(self.spool_path(f)) for f in os.listdir(self.spool_dir))
+
+    def fetch_to_spool(self, name):
+        tmp = self.spool_path(name + '.tmp')
+        try:
+            if self.fetch(name, tmp):
+                os.rename(tmp, self.spool_path(name))
+        except (IOError, OSError):
+            pass
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        if not os.path.exists(self.spool_path(name)):
+            self.misses.append(name)
+
+    def restore(self, name, path):
+        self.clean_spool(name)
+        if os.path.exists(self.spool_path(name)):
+            shutil.move(self.spool_path(name), path)
+            return True
+
+        missing = self.missing()
+        wanted = [] if missing and name >= missing else next_segments(name, self.prefetch)
+        wanted = [n for n in wanted if not os.path.exists(self.spool_path(n))]
+        wanted = wanted[:max((self.max_spool_size - self.spool_size()) // WAL_SEGMENT_SIZE, 0)]
+        self.misses = []
+        threads = [Thread(target=self.fetch_to_spool, args=(n,)) for n in wanted]
+        for t in threads:
+            t.start()
+        ok = False
+        try:
+            ok = self.fetch(name, path)
+        except (IOError, OSError):
+            pass
+        finally:
+            for t in threads:
+                t.join()
+        if SEGMENT_RE.match(name):
+            misses = self.misses + ([] if ok else [name])
+            self.set_missing(misses and min(misses))
+        return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='restore_command with parallel prefetching')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--archive-dir', help='fetch from this directory')
+    source.add_argument('--wal-e-env-dir', help='fetch with wal-e using the settings from this envdir')
+    parser.add_argument('--spool-dir', required=True)
+    parser.add_argument('--prefetch', type=int, default=8, help='number of segments fetched ahead')
+    parser.add_argument('--max-spool-size', type=int, help='in bytes, defaults to prefetch * 16MB')
+    parser.add_argument('name', help='%%f')
+    parser.add_argument('path', help='%%p')
+    args = parser.parse_args()
+
+    fetch = archive_dir_fetch(args.archive_dir) if args.archive_dir else wal_e_fetch(args.wal_e_env_dir)
+    restore = WalRestore(fetch, args.spool_dir, args.prefetch, args.max_spool_size)
+    return 0 if restore.restore(args.name, args.path) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import logging
+import subprocess
+import time
+
+from helpers.utils import segment_to_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def parse_backup_list(output):
+    """ returns the backup from the output of `wal-e backup-list --detail LATEST`
+
+    >>> header = b'name last_modified expanded_size_bytes wal_segment_backup_start '
+    >>> header += b'wal_segment_offset_backup_start wal_segment_backup_stop wal_segment_offset_backup_stop\\n'
+    >>> b = parse_backup_list(header + b'base_00000001000000000000007F_00000040 2015-05-18T10:13:25.000Z 20310671 '
+    ...                       b'00000001000000000000007F 00000040 00000001000000000000007F 00000240')
+    >>> b['expanded_size_bytes'], b['start']
+    (20310671, 2130706472)
+    >>> parse_backup_list(b'name last_modified')
+    """
+    lines = output.decode('utf-8').splitlines() if output else ()
+    if len(lines) != 2:
+        return None
+
+    names = lines[0].split()
+    values = lines[1].split()
+    if len(names) != len(values) or len(names) != 7:
+        return None
+
+    backup = dict(zip(names, values))
+    try:
+        backup['expanded_size_bytes'] = int(backup['expanded_size_bytes'])
+        # wal-e reports the offset within the start segment as a decimal number
+        backup['start'] = segment_to_bytes(backup['wal_segment_backup_start']) + \
+            int(backup['wal_segment_offset_backup_start'])
+    except (KeyError, ValueError):
+        logger.exception('unable to get some of S3 backup parameters')
+        return None
+    return backup
+
+
+class BackupCatalog:
+    """ The latest base backup in the WAL-E storage.
+
+        `backup-list` has to walk the bucket, so a successful answer is kept for `ttl` seconds. """
+
+    def __init__(self, wal_e_path, ttl=300):
+        self.wal_e_path = wal_e_path
+        self.ttl = ttl
+        self.backup = None
+        self.expires = 0
+
+    def fetch(self):
+        try:
+            output = subprocess.check_output(self.wal_e_path.split() + ['backup-list', '--detail', 'LATEST'])
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception('could not query wal-e latest backup')
+            return None
+        return parse_backup_list(output)
+
+    def latest(self):
+        now = time.time()
+        if self.expires <= now:
+            self.backup = self.fetch()
+            self.expires = now + self.ttl if self.backup else 0
+        return self.backup
@@ -0,0 +1,134 @@
+import psycopg2
+import socket
+import time
+import unittest
+
+from helpers.agent_check import AgentCheckServer
+from helpers.etcd import Cluster
+from threading import Thread
+
+
+class MockCursor:
+
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, sql, *params):
+        if not self.row:
+            raise psycopg2.OperationalError()
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+class MockConnection:
+
+    closed = 0
+
+    def __init__(self, row):
+        self.row = row
+
+    def cursor(self):
+        return MockCursor(self.row)
+
+    def close(self):
+        self.closed = 1
+
+
+class Stop(Exception):
+    pass
+
+
+def stop(*args):
+    raise Stop()
+
+
+def os_error(*args):
+    raise OSError()
+
+
+class MockPostgresql:
+
+    row = (True, 3000, 1000, False, 10, 100)
+
+    def connect_database(self, database):
+        return MockConnection(self.row)
+
+
+class MockHa:
+
+    cluster = Cluster(True, None, 2000, [])
+
+
+class MockGovernor:
+
+    def __init__(self):
+        self.postgresql = MockPostgresql()
+        self.ha = MockHa()
+
+
+class TestAgentCheck(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestAgentCheck, self).__init__(method_name)
+
+    def set_up(self):
+        self.governor = MockGovernor()
+        self.server = AgentCheckServer(self.governor, {'listen': '127.0.0.1:0', 'max_lag_bytes': 1000})
+        self.server.cpus = 1000
+
+    def tear_down(self):
+        self.server.server_close()
+
+    def check(self, send=None):
+        thread = Thread(target=self.server.handle_request)
+        thread.start()
+        client = socket.create_connection(self.server.server_address)
+        try:
+            if send:
+                client.sendall(send)
+            return client.recv(64)
+        finally:
+            client.close()
+            thread.join()
+
+    def test_refresh(self):
+        self.server.refresh()
+        self.assertEqual(self.server.status['lag'], 2000)
+        self.assertEqual(self.server.response(), 'drain')
+        self.governor.postgresql.row = (True, 2500, 1900, False, 10, 100)
+        self.server._connection = None
+        self.server.refresh()
+        self.assertEqual(self.server.status['lag'], 600)
+        self.assertEqual(self.server.response(), 'up 40%')
+        self.assertEqual(self.server.response('master'), 'down')
+        self.governor.postgresql.row = (False, None, None, False, 50, 100)
+        self.server._connection = None
+        self.server.refresh()
+        self.assertEqual(self.server.response('master'), 'up 50%')
+        self.server._connection.row = None
+        self.server.refresh()
+        self.assertEqual(self.server.response(), 'down')
+
+    def test_refresh_forever(self):
+        self.server.status = {'role': 'master', 'weight': 100}
+        self.governor.postgresql.connect_database = os_error
+        time_sleep = time.sleep
+        time.sleep = stop
+        try:
+            self.assertRaises(Stop, self.server.refresh_forever)
+        finally:
+            time.sleep = time_sleep
+        self.assertIsNone(self.server.status)
+
+    def test_handle(self):
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.status = {'role': 'master', 'weight': 100}
+        self.assertEqual(self.check(), b'up 100%\n')
+        self.assertEqual(self.check(b'replica\n'), b'down\n')
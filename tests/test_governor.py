@@ -1,5 +1,7 @@
+import helpers.postgresql
 import psycopg2
 import requests
+import select
 import subprocess
 import sys
 import time
@@ -8,7 +10,7 @@ import yaml
 
 from governor import Governor, main
 from test_ha import true, false
-from test_postgresql import Postgresql, subprocess_call, psycopg2_connect
+from test_postgresql import Postgresql, subprocess_call, psycopg2_connect, run_basebackup
 from test_etcd import requests_get, requests_put, requests_delete
 
 if sys.hexversion >= 0x03000000:
@@ -25,6 +27,10 @@ def time_sleep(_):
     raise Exception()
 
 
+def select_select_raises(*args):
+    raise Exception()
+
+
 class TestGovernor(unittest.TestCase):
 
     def __init__(self, method_name='runTest'):
@@ -35,6 +41,7 @@ class TestGovernor(unittest.TestCase):
     def set_up(self):
         self.touched = False
         subprocess.call = subprocess_call
+        helpers.postgresql.run_basebackup = run_basebackup
         psycopg2.connect = psycopg2_connect
         requests.get = requests_get
         requests.put = requests_put
@@ -59,7 +66,13 @@ class TestGovernor(unittest.TestCase):
         main()
         sys.argv = ['governor.py', 'postgres0.yml']
         time.sleep = time_sleep
-        self.assertRaises(Exception, main)
+        # the loop waits in select, this ends it
+        select_select = select.select
+        select.select = select_select_raises
+        try:
+            self.assertRaises(Exception, main)
+        finally:
+            select.select = select_select
 
     def touch_member(self):
         if not self.touched:
@@ -67,6 +80,30 @@ class TestGovernor(unittest.TestCase):
             return False
         return True
 
+    def test_touch_member(self):
+        self.g.postgresql.tags = {'replicatefrom': 'postgresql1'}
+        self.g.etcd.touch_member = lambda name, connection_string, ttl: connection_string
+        self.assertTrue(self.g.touch_member().endswith('/governor&replicatefrom=postgresql1'))
+        self.g.postgresql.failover_score = 1263.2
+        self.assertTrue(self.g.touch_member().endswith('/governor&replicatefrom=postgresql1&score=1263.2'))
+        self.g.postgresql.parked_slots = {'postgresql2': 0, 'postgresql1': 0}
+        self.assertTrue(self.g.touch_member().endswith('&score=1263.2&parked=postgresql1%2Cpostgresql2'))
+        self.g.postgresql.tags = {'nofailover': False, 'nosync': True}
+        self.assertIn('/governor&nofailover=false&nosync=true&score=', self.g.touch_member())
+
+    def test_on_role_change(self):
+        roles = []
+        self.g.haproxy = type('MockHAProxy', (), {'on_role_change': lambda _, role: roles.append(role) or True})()
+        self.assertFalse(self.g.on_role_change('master'))  # not running on EC2
+        self.assertEqual(roles, ['master'])
+
+    def test_reload_config(self):
+        self.g.config_file = 'postgres0.yml'
+        self.g.postgresql.reload_config = lambda config: self.assertIn('parameters', config)
+        self.g.reload_config()
+        self.g.config_file = 'missing.yml'
+        self.g.reload_config()
+
     def test_governor_initialize(self):
         self.g.postgresql.should_use_s3_to_create_replica = false
         self.g.etcd.base_client_url = 'http://remote'
@@ -85,5 +122,9 @@ class TestGovernor(unittest.TestCase):
         self.assertRaises(Exception, self.g.initialize)
 
     def test_schedule_next_run(self):
-        self.g.next_run = time.time() - self.g.nap_time - 1
+        self.g.scheduler.next_run = time.time() - self.g.scheduler.interval - 1
+        self.g.schedule_next_run()
+        self.assertEqual(self.g.scheduler.interval, self.g.scheduler.min_interval)
+        self.g.ha.stable = True
+        self.g.scheduler.next_run = time.time() - self.g.scheduler.max_interval - 1
         self.g.schedule_next_run()
@@ -2,9 +2,10 @@ import unittest
 import requests
 
 from helpers.errors import EtcdError
-from helpers.etcd import Cluster, Etcd
+from helpers.etcd import Cluster, Etcd, Member
 from helpers.ha import Ha
 from test_etcd import requests_get, requests_put, requests_delete
+from threading import Thread
 
 
 def true(*args, **kwargs):
@@ -20,11 +21,20 @@ class MockPostgresql:
     def __init__(self):
         self.name = 'postgresql0'
         self.is_promoted = False
+        self.synchronous_mode = False
+        self.synchronous_standby = []
+        self.role = 'master'
 
     def is_healthy(self):
         return True
 
-    def write_recovery_conf(self, _):
+    def write_recovery_conf(self, leader, slot=True):
+        return True
+
+    def upstream(self, cluster):
+        return cluster.leader, True
+
+    def rejoin(self, _):
         return True
 
     def start(self):
@@ -42,12 +52,36 @@ class MockPostgresql:
     def demote(self, _):
         return True
 
-    def follow_the_leader(self, _):
+    def follow_the_leader(self, leader, slot=True):
         return True
 
     def create_replication_slots(self, _):
         return True
 
+    def track_catchup(self):
+        pass
+
+    def update_failover_score(self, cluster):
+        pass
+
+    def update_prewarm_snapshot(self, leader=None):
+        pass
+
+    def pick_synchronous_standby(self, cluster):
+        return ['postgresql1']
+
+    def set_synchronous_standby(self, names):
+        self.synchronous_standby = names
+
+    def cleanup_archive(self):
+        pass
+
+    def is_stale(self, _):
+        return False
+
+    def resync_from_leader(self, _):
+        return True
+
     def last_operation(self):
         return 0
 
@@ -81,6 +115,26 @@ class TestHa(unittest.TestCase):
         self.p.is_healthy = false
         self.assertEquals(self.ha.run_cycle(), 'started as a secondary')
 
+    def test_rejoin_fails(self):
+        self.p.is_healthy = self.p.rejoin = false
+        self.p.write_recovery_conf = self.p.start = None  # must not be called
+        self.assertEquals(self.ha.run_cycle(), 'postgresql was not running and could not rejoin the leader')
+
+    def test_release_lock_when_start_fails(self):
+        self.p.is_healthy = self.p.start = false
+        self.ha.has_lock = true
+        self.ha.master_restart_attempts = 2
+        self.assertEquals(self.ha.run_cycle(), 'failed to start postgresql while holding the session lock')
+        self.assertEquals(self.ha.run_cycle(), 'released session lock because postgresql failed to start')
+        self.assertEquals(self.ha.failed_starts, 0)
+
+    def test_release_lock_immediately(self):
+        self.p.is_healthy = false
+        self.ha.has_lock = true
+        self.ha.master_restart_attempts = 0
+        self.assertEquals(self.ha.run_cycle(),
+                          'released session lock and started as a secondary because postgresql was not running')
+
     def test_start_as_readonly(self):
         self.ha.cluster.is_unlocked = false
         self.p.is_leader = self.p.is_healthy = false
@@ -117,11 +171,35 @@ class TestHa(unittest.TestCase):
         self.ha.has_lock = true
         self.p.is_leader = false
         self.assertEquals(self.ha.run_cycle(), 'promoted self to leader because i had the session lock')
+        self.assertFalse(self.ha.stable)
 
     def test_leader_with_lock(self):
         self.ha.cluster.is_unlocked = false
         self.ha.has_lock = true
         self.assertEquals(self.ha.run_cycle(), 'no action.  i am the leader with the lock')
+        self.assertTrue(self.ha.stable)
+
+    def test_update_synchronous_standby(self):
+        self.ha.cluster = Cluster(True, None, 0, [], {'leader': 'postgresql0', 'sync_standby': []})
+        self.ha.update_synchronous_standby()
+        self.p.synchronous_mode = True
+        states = []
+        self.e.set_sync_state = lambda leader, sync_standby: states.append(sync_standby) or True
+        self.ha.update_synchronous_standby()
+        self.assertEqual(self.p.synchronous_standby, ['postgresql1'])
+        self.assertEqual(states, [['postgresql1']])
+
+        # the new standby is recorded before postgres waits for it, the old one is removed afterwards
+        self.ha.cluster = Cluster(True, None, 0, [], {'leader': 'postgresql0', 'sync_standby': ['postgresql2']})
+        self.p.synchronous_standby = ['postgresql2']
+        self.ha.update_synchronous_standby()
+        self.assertEqual(states[1:], [['postgresql2', 'postgresql1'], ['postgresql1']])
+
+        # postgres isn't reloaded when recording failed
+        self.e.set_sync_state = false
+        self.p.synchronous_standby = ['postgresql2']
+        self.ha.update_synchronous_standby()
+        self.assertEqual(self.p.synchronous_standby, ['postgresql2'])
 
     def test_demote_because_not_having_lock(self):
         self.ha.cluster.is_unlocked = false
@@ -132,6 +210,31 @@ class TestHa(unittest.TestCase):
         self.p.is_leader = false
         self.assertEquals(self.ha.run_cycle(), 'no action.  i am a secondary and i am following a leader')
 
+    def test_resync_stale_secondary(self):
+        self.ha.cluster.is_unlocked = false
+        self.p.is_leader = false
+        self.p.is_stale = true
+        self.assertEquals(self.ha.run_cycle(), 'resynchronized stale secondary from the leader')
+
+    def test_watch(self):
+        self.ha.cluster.is_unlocked = false
+        self.ha.has_lock = true
+        self.ha.run_cycle()
+        self.assertEqual(self.ha.watch(), {'version': 1, 'role': 'master', 'leader': 'postgresql0'})
+        self.assertEqual(self.ha.watch(1, 0.01)['version'], 1)
+        self.ha.run_cycle()
+        self.assertEqual(self.ha.version, 1)
+
+        results = []
+        watcher = Thread(target=lambda: results.append(self.ha.watch(1, 10)))
+        watcher.start()
+        self.p.role = 'replica'
+        self.ha.cluster = Cluster(True, Member('postgresql1', '', None, 30), 0, [])
+        self.ha.update_topology()
+        watcher.join()
+        self.assertEqual(results[0]['leader'], 'postgresql1')
+        self.assertEqual(self.ha.watch(1), {'version': 2, 'role': 'replica', 'leader': 'postgresql1'})
+
     def test_no_etcd_connection_master_demote(self):
         self.ha.load_cluster_from_etcd = dead_etcd
         self.assertEquals(self.ha.run_cycle(), 'demoted self because etcd is not accessible and i was a leader')
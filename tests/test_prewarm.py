@@ -0,0 +1,132 @@
+import os
+import psycopg2
+import requests
+import shutil
+import unittest
+
+from helpers.etcd import Member
+from helpers.prewarm import Prewarmer, relation_path
+from requests.exceptions import RequestException
+
+RANGES = [[0, 1664, 1262, 0, 0, 0], [16384, 1663, 16385, 0, 0, 2047], [16384, 1663, 16386, 0, 0, 0],
+          [16390, 1663, 16391, 0, 0, 0]]
+
+
+class MockCursor:
+
+    def __init__(self, database):
+        self.database = database
+        self.results = []
+
+    def execute(self, sql, params=None):
+        if 'pg_buffercache' in sql and sql.startswith('SELECT EXISTS'):
+            self.results = [(self.database == 'postgres',)]
+        elif 'pg_prewarm' in sql and sql.startswith('SELECT EXISTS'):
+            self.results = [(self.database == 'db1',)]
+        elif sql.startswith('SELECT reldatabase'):
+            self.results = [tuple(r) for r in RANGES]
+        elif sql.startswith('SELECT oid, datname'):
+            self.results = [(16384, 'db1'), (16390, 'db2')]
+        elif sql.startswith('SELECT pg_relation_filenode'):
+            self.results = [(16385, 16385), (16386, 16400)]
+        elif sql.startswith('SELECT pg_prewarm'):
+            if params[0] == 16400:
+                raise psycopg2.ProgrammingError()
+            self.results = [(params[3] - params[2] + 1,)]
+        else:
+            raise psycopg2.OperationalError()
+
+    def fetchone(self):
+        return self.results[0]
+
+    def fetchall(self):
+        return self.results
+
+    def __iter__(self):
+        return iter(self.results)
+
+
+class MockConnection:
+
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return MockCursor(self.database)
+
+    def close(self):
+        pass
+
+
+def connect(database):
+    if database == 'db2':
+        raise psycopg2.OperationalError()
+    return MockConnection(database)
+
+
+class MockResponse:
+
+    def json(self):
+        return {'created': 1, 'ranges': RANGES}
+
+
+def requests_get(url, timeout=None):
+    if url.startswith('http://dead'):
+        raise RequestException()
+    return MockResponse()
+
+
+class TestPrewarm(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestPrewarm, self).__init__(method_name)
+
+    def set_up(self):
+        self.data_dir = 'data/prewarm'
+        os.makedirs(os.path.join(self.data_dir, 'base', '16390'))
+        with open(os.path.join(self.data_dir, 'base', '16390', '16391'), 'wb') as f:
+            f.write(b'\0' * 8192)
+        os.makedirs(os.path.join(self.data_dir, 'pg_tblspc', '16500', 'PG_9.4_201409291'))
+        self.prewarmer = Prewarmer(os.path.join(self.data_dir, 'governor_prewarm.json'), connect, rate=1 << 40)
+        self.requests_get = requests.get
+        requests.get = requests_get
+
+    def tear_down(self):
+        requests.get = self.requests_get
+        shutil.rmtree('data')
+
+    def test_relation_path(self):
+        self.assertEqual(relation_path(self.data_dir, 16384, 16500, 16385, 1),
+                         os.path.join(self.data_dir, 'pg_tblspc', '16500', 'PG_9.4_201409291', '16384', '16385_fsm'))
+
+    def test_snapshot(self):
+        self.assertFalse(self.prewarmer.start(self.data_dir))
+        self.assertTrue(self.prewarmer.update())
+        self.prewarmer.updater.join()
+        self.assertFalse(self.prewarmer.update())
+        self.assertEqual(self.prewarmer.load()['ranges'], RANGES)
+        # without pg_buffercache
+        self.prewarmer.connect = lambda database: MockConnection('db1')
+        os.unlink(self.prewarmer.path)
+        self.prewarmer.update_snapshot()
+        self.assertIsNone(self.prewarmer.load())
+        self.prewarmer.connect = connect
+        self.prewarmer.update_snapshot(Member('leader', '', 'http://dead:8008/governor', 30))
+        self.assertIsNone(self.prewarmer.load())
+        self.prewarmer.update_snapshot(Member('leader', '', 'http://127.0.0.1:8008/governor', 30))
+        self.assertEqual(self.prewarmer.load()['ranges'], RANGES)
+
+    def test_prewarm(self):
+        self.prewarmer.update_snapshot()
+        self.assertTrue(self.prewarmer.start(self.data_dir))
+        self.prewarmer.thread.join()
+        self.assertEqual(self.prewarmer.progress['state'], 'done')
+        self.assertEqual(self.prewarmer.progress['blocks_done'], 2051)
+
+        self.prewarmer.rate = 8192 * 1000
+        self.prewarmer.run(self.data_dir, RANGES[-1:])
+        self.prewarmer.connect = lambda database: connect('db2')
+        self.prewarmer.run(self.data_dir, RANGES)
+        self.assertEqual(self.prewarmer.progress['state'], 'failed')
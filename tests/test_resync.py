@@ -0,0 +1,119 @@
+import hashlib
+import os
+import psycopg2
+import shutil
+import unittest
+
+from helpers.resync import EXCLUDE_DIRS, Resync
+
+LEADER_DIR = 'data/leader'
+REPLICA_DIR = 'data/replica'
+
+
+SLOTS = []
+
+
+class MockCursor:
+
+    def __init__(self):
+        self.results = []
+
+    def execute(self, sql, params=None):
+        self.results = []
+        if sql.startswith("SELECT current_setting('server_version_num')"):
+            self.results = [(True, params[0] in SLOTS)]
+        elif sql.startswith('SELECT pg_create_physical_replication_slot(%s, true)'):
+            SLOTS.append(params[0])
+        elif sql.startswith('WITH RECURSIVE files'):
+            for root, dirs, files in os.walk(LEADER_DIR):
+                for name in dirs + files:
+                    path = os.path.relpath(os.path.join(root, name), LEADER_DIR)
+                    if os.path.dirname(path) in EXCLUDE_DIRS:
+                        continue
+                    st = os.stat(os.path.join(root, name))
+                    self.results.append((path, st.st_size, int(st.st_mtime), name in dirs))
+        elif sql.startswith('SELECT md5('):
+            path, chunk_size, size, _ = params
+            with open(os.path.join(LEADER_DIR, path), 'rb') as f:
+                for offset in range(0, size, chunk_size):
+                    self.results.append((hashlib.md5(f.read(chunk_size)).hexdigest(),))
+        elif sql.startswith('SELECT o, pg_read_binary_file'):
+            path, chunk_size, offsets = params
+            with open(os.path.join(LEADER_DIR, path), 'rb') as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    self.results.append((offset, memoryview(f.read(chunk_size))))
+
+    def fetchone(self):
+        return self.results[0]
+
+    def fetchall(self):
+        return self.results
+
+
+class MockConnect:
+
+    def __init__(self):
+        self.autocommit = False
+
+    def cursor(self):
+        return MockCursor()
+
+    def close(self):
+        pass
+
+
+def psycopg2_connect(*args, **kwargs):
+    return MockConnect()
+
+
+def write(path, data):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class TestResync(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestResync, self).__init__(method_name)
+
+    def set_up(self):
+        psycopg2.connect = psycopg2_connect
+        write(os.path.join(LEADER_DIR, 'base', '1', '1234'), b'a' * 40 + b'b' * 20)
+        write(os.path.join(LEADER_DIR, 'base', '1', '1235'), b'new')
+        write(os.path.join(LEADER_DIR, 'pg_xlog', '000000010000000000000001'), b'wal')
+        write(os.path.join(LEADER_DIR, 'global', 'pg_control'), b'control')
+        write(os.path.join(REPLICA_DIR, 'base', '1', '1234'), b'a' * 40 + b'c' * 30)
+        write(os.path.join(REPLICA_DIR, 'base', '1', '4321'), b'dropped')
+        write(os.path.join(REPLICA_DIR, 'pg_xlog', '000000010000000000000000'), b'old wal')
+        write(os.path.join(REPLICA_DIR, 'recovery.conf'), b'standby_mode = on')
+
+    def tear_down(self):
+        shutil.rmtree('data')
+
+    def test_run(self):
+        stats = Resync(REPLICA_DIR, {}, 10).run()
+        self.assertEqual(read(os.path.join(REPLICA_DIR, 'base', '1', '1234')), b'a' * 40 + b'b' * 20)
+        self.assertEqual(read(os.path.join(REPLICA_DIR, 'base', '1', '1235')), b'new')
+        self.assertFalse(os.path.exists(os.path.join(REPLICA_DIR, 'base', '1', '4321')))
+        self.assertEqual(os.listdir(os.path.join(REPLICA_DIR, 'pg_xlog')), [])
+        self.assertTrue(os.path.exists(os.path.join(REPLICA_DIR, 'recovery.conf')))
+        self.assertEqual(stats['bytes_total'], 70)
+        self.assertEqual(stats['bytes_fetched'], 30)
+        self.assertEqual(stats['bytes_saved'], 40)
+
+        stats = Resync(REPLICA_DIR, {}, 10, 'replica').run()
+        self.assertEqual(stats['bytes_fetched'], 0)
+        self.assertEqual(SLOTS, ['replica'])
+        Resync(REPLICA_DIR, {}, 10, 'replica').run()
+        self.assertEqual(SLOTS, ['replica'])
+        self.assertEqual(stats['files_copied'], 0)
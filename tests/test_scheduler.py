@@ -0,0 +1,59 @@
+import os
+import signal
+import time
+import unittest
+
+from helpers.scheduler import Scheduler
+from helpers.utils import setup_signal_handlers, wakeup
+
+
+def nop(*args, **kwargs):
+    pass
+
+
+class TestScheduler(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestScheduler, self).__init__(method_name)
+
+    def set_up(self):
+        self.time_sleep = time.sleep
+        time.sleep = nop
+        self.s = Scheduler({'loop_wait': 10, 'min_loop_wait': 1})
+
+    def tear_down(self):
+        time.sleep = self.time_sleep
+
+    def test_min_interval(self):
+        self.assertEqual(Scheduler({'loop_wait': 10}).min_interval, 10)
+        self.assertEqual(Scheduler({'loop_wait': 10, 'min_loop_wait': 20}).min_interval, 10)
+        self.assertRaises(ValueError, Scheduler, {'loop_wait': 10, 'min_loop_wait': 0})
+        self.assertRaises(ValueError, Scheduler, {'loop_wait': 0})
+
+    def test_update(self):
+        self.assertEqual(self.s.update(True), 10)
+        self.assertEqual(self.s.update(False), 1)
+        self.assertEqual(self.s.update(True, 21), 2)
+        self.assertEqual(self.s.update(True, 10), 1)
+        for _ in range(10):
+            self.assertLessEqual(self.s.update(True), self.s.max_interval)
+        self.assertEqual(self.s.interval, 10)
+
+    def test_schedule_next_run(self):
+        self.s.next_run = time.time() - self.s.interval - 1
+        self.s.schedule_next_run()
+        self.s.reset()
+        setup_signal_handlers()
+        wakeup()
+        self.s.schedule_next_run(os.getpid())
+        self.assertLessEqual(self.s.next_run, time.time())
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def test_align(self):
+        s = Scheduler({'loop_wait': 10}, 'batman/postgresql0')
+        self.assertAlmostEqual(s.align(s.phase + 25), s.phase + 20)
+        self.assertEqual(s.phase, Scheduler({'loop_wait': 10}, 'batman/postgresql0').phase)
+        self.assertNotEqual(s.phase, Scheduler({'loop_wait': 10}, 'batman/postgresql1').phase)
@@ -0,0 +1,156 @@
+import psycopg2
+import requests
+import time
+import unittest
+
+from helpers.errors import SwitchoverError
+from helpers.etcd import Etcd
+from helpers.ha import Ha
+from helpers.switchover import Switchover
+from test_etcd import requests_get, requests_put, requests_delete
+from test_ha import MockPostgresql, false, nop
+
+
+def requests_post(url, **kwargs):
+    raise requests.exceptions.RequestException()
+
+
+def throws(*args, **kwargs):
+    raise psycopg2.OperationalError()
+
+
+class MockPrimary(MockPostgresql):
+
+    def __init__(self):
+        MockPostgresql.__init__(self)
+        self.name = 'postgresql1'
+        self.config = {'maximum_lag_on_failover': 10}
+        self.started = False
+
+    def xlog_position(self):
+        return 100
+
+    def checkpoint(self):
+        pass
+
+    def stop(self):
+        return False
+
+    def start(self):
+        self.started = True
+        return True
+
+    def controldata(self):
+        return {'Latest checkpoint location': '0/78'}
+
+
+class TestSwitchover(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestSwitchover, self).__init__(method_name)
+
+    def set_up(self):
+        requests.get = requests_get
+        requests.put = requests_put
+        requests.delete = requests_delete
+        requests.post = requests_post
+        self.time_sleep = time.sleep
+        time.sleep = nop
+        self.p = MockPrimary()
+        self.e = Etcd({'ttl': 30, 'host': 'remotehost', 'scope': 'test'})
+        self.ha = Ha(self.p, self.e)
+        # the shutdown checkpoint record ends at 0x78 + 112
+        self.positions = [(True, 90, 90), (True, 232, 100), (False, 232, 232)]
+
+    def tear_down(self):
+        time.sleep = self.time_sleep
+
+    def member_positions(self, member):
+        return self.positions[0] if len(self.positions) == 1 else self.positions.pop(0)
+
+    def switchover(self, member=None, timeout=None):
+        s = Switchover(self.ha, member, timeout)
+        s.member_positions = self.member_positions
+        return s.run()
+
+    def test_switchover(self):
+        report = self.switchover('postgresql0')
+        self.assertTrue(report['success'])
+        self.assertEqual(report['to'], 'postgresql0')
+        self.assertEqual([p['name'] for p in report['phases']],
+                         ['choose_target', 'checkpoint', 'catchup', 'stop', 'final_wal', 'handover', 'promote'])
+        self.assertFalse(self.p.started)
+
+    def test_not_leader(self):
+        self.p.name = 'postgresql0'
+        self.assertRaises(SwitchoverError, self.switchover)
+
+    def test_unknown_member(self):
+        report = self.switchover('foo')
+        self.assertFalse(report['success'])
+        self.assertEqual(report['error'], 'member foo is not known')
+
+    def test_no_replicas(self):
+        self.positions = [(False, 0, 0)]
+        self.assertEqual(self.switchover()['error'], 'no healthy replica to switch over to')
+        s = Switchover(self.ha)
+        s.member_positions = throws
+        self.assertEqual(s.run()['error'], 'no healthy replica to switch over to')
+
+    def test_final_wal_timeout(self):
+        self.positions = [(True, 90, 90), (True, 231, 231)]
+        report = self.switchover(timeout=0.01)
+        self.assertEqual(report['error'], 'timed out waiting for the shutdown checkpoint')
+        self.assertTrue(self.p.started)
+
+    def test_lost_lock(self):
+        self.positions = [(True, 100, 100)]
+        s = Switchover(self.ha, timeout=0.01)
+        s.member_positions = self.member_positions
+        s.lock_is_ours = false
+        self.assertEqual(s.run()['error'], 'timed out waiting for the shutdown checkpoint')
+        self.assertFalse(self.p.started)
+
+    def test_renew_lock(self):
+        renewed = []
+        self.ha.update_lock = lambda: renewed.append(1) or True
+        s = Switchover(self.ha)
+        s.lock_expires = time.time() + 20
+        s.renew_lock()
+        self.assertEqual(renewed, [])
+        s.lock_expires = time.time() + 10
+        s.renew_lock()
+        self.assertEqual(renewed, [1])
+        s.stopped = True
+        s.renew_lock(True)
+        self.assertEqual(renewed, [1])
+        s.stopped = False
+        self.ha.update_lock = false
+        self.assertRaises(SwitchoverError, s.renew_lock, True)
+
+        # the lock is renewed while waiting for the replica
+        self.positions = [(True, 90, 90), (True, 90, 80), (True, 90, 90), (True, 232, 100), (False, 232, 232)]
+        s = Switchover(self.ha, 'postgresql0')
+        s.member_positions = self.member_positions
+        renewed = []
+
+        def renew_lock(force=False):
+            renewed.append(force)
+            s.lock_expires = time.time() + 30
+        s.renew_lock = renew_lock
+        self.assertTrue(s.run()['success'])
+        # before every phase, in the stop phase and while the replica was catching up
+        self.assertEqual(renewed, [False] * 5 + [True] + [False] * 3)
+
+    def test_failed_stop(self):
+        self.p.stop = lambda: True
+        self.assertEqual(self.switchover()['error'], 'failed to stop postgresql')
+        self.positions = [(True, 100, 100)]
+        self.ha.update_lock = false
+        self.assertEqual(self.switchover()['error'], 'failed to update the leader lock')
+
+    def test_failed_handover(self):
+        self.e.switch_leader = false
+        self.assertEqual(self.switchover()['error'], 'failed to hand over the leader lock')
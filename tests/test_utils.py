@@ -1,8 +1,11 @@
 import os
+import signal
+import subprocess
 import time
 import unittest
 
-from helpers.utils import sigchld_handler, sigterm_handler, sleep
+from helpers.utils import reload_requested, setup_signal_handlers, sigchld_handler, sighup_handler, sigterm_handler, \
+    sleep, wait, wakeup
 
 
 def nop(*args, **kwargs):
@@ -39,6 +42,24 @@ class TestUtils(unittest.TestCase):
         os.waitpid = os_waitpid
         sigchld_handler(None, None)
 
+    def test_sighup_handler(self):
+        sighup_handler(None, None)
+        self.assertTrue(reload_requested())
+        self.assertFalse(reload_requested())
+        wait(0.01)  # consume the wakeup
+
     def test_sleep(self):
         time.sleep = time_sleep
         sleep(0.01)
+
+    def test_wait(self):
+        self.assertEqual(wait(0.01), 'timeout')
+        self.assertEqual(wait(0.01, os.getpid()), 'timeout')
+        setup_signal_handlers()
+        wakeup()
+        self.assertEqual(wait(5), 'wakeup')
+        child = subprocess.Popen(['sleep', '0.05'])
+        self.assertEqual(wait(5, child.pid), 'exited')
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
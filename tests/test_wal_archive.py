@@ -0,0 +1,86 @@
+import os
+import shutil
+import sys
+import unittest
+
+from helpers.wal_archive import WalArchiver, lzma, main
+from helpers.wal_restore import archive_dir_fetch
+
+SEGMENTS = ['000000010000000000000001', '000000010000000000000002', '000000010000000000000003']
+
+
+class TestWalArchiver(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestWalArchiver, self).__init__(method_name)
+
+    def set_up(self):
+        self.status_dir = 'data/pg/pg_xlog/archive_status'
+        os.makedirs(self.status_dir)
+        for name in SEGMENTS:
+            with open(os.path.join('data/pg/pg_xlog', name), 'wb') as f:
+                f.write(name.encode('utf-8') * 1000)
+            open(os.path.join(self.status_dir, name + '.ready'), 'w').close()
+        self.archiver = WalArchiver('data/pg', 'data/archive', workers=2)
+        self.archiver.start()
+
+    def tear_down(self):
+        shutil.rmtree('data')
+
+    def test_archive(self):
+        self.assertTrue(self.archiver.archive(SEGMENTS[0]))
+        # the next segment was ready and archived in the same batch
+        self.assertEqual(sorted(os.listdir('data/archive')), [n + '.gz' for n in SEGMENTS[:2]])
+        self.assertEqual(self.archiver.archived, set([SEGMENTS[1]]))
+        self.assertTrue(self.archiver.archive(SEGMENTS[1]))
+        status = self.archiver.status()
+        self.assertEqual((status['pending'], status['last_archived']), (3, SEGMENTS[1]))
+        self.assertLess(status['compression_ratio'], 0.1)
+        self.assertFalse(self.archiver.archive('000000010000000000000009'))
+        self.assertEqual(self.archiver.status()['failed'], 1)
+        self.assertRaises(ValueError, self.archiver.archive, '../postgresql.conf')
+
+        fetch = archive_dir_fetch('data/archive')
+        self.assertTrue(fetch(SEGMENTS[0], 'data/restored'))
+        with open('data/restored', 'rb') as f:
+            self.assertEqual(f.read(), SEGMENTS[0].encode('utf-8') * 1000)
+
+    def test_lzma(self):
+        if not lzma:
+            return self.assertRaises(ValueError, WalArchiver, 'data/pg', 'data/archive', 'lzma')
+        self.assertTrue(WalArchiver('data/pg', 'data/xz', 'lzma').archive(SEGMENTS[2]))
+        self.assertTrue(archive_dir_fetch('data/xz')(SEGMENTS[2], 'data/restored'))
+
+    def test_push(self):
+        argv = sys.argv
+        # nobody is listening there, the command archives the segment itself
+        sys.argv = ['wal_archive.py', 'push', '--api-url', 'http://127.0.0.1:1', '--data-dir', 'data/pg',
+                    '--archive-dir', 'data/archive', '--compression', 'none', SEGMENTS[2]]
+        try:
+            self.assertEqual(main(), 0)
+        finally:
+            sys.argv = argv
+        self.assertTrue(os.path.exists(os.path.join('data/archive', SEGMENTS[2])))
+
+    def test_archived_already(self):
+        archiver = WalArchiver('data/pg', 'data/archive')
+        self.assertTrue(archiver.archive(SEGMENTS[0]))
+        # postgres crashed before it noticed, the same file is archived again
+        archiver.archived.clear()
+        self.assertTrue(archiver.archive(SEGMENTS[0]))
+        # a segment of a diverged history never replaces the archived one
+        archiver.archived.clear()
+        with open(os.path.join('data/pg/pg_xlog', SEGMENTS[0]), 'wb') as f:
+            f.write(b'diverged' * 1000)
+        self.assertFalse(archiver.archive(SEGMENTS[0]))
+        self.assertTrue(archive_dir_fetch('data/archive')(SEGMENTS[0], 'data/restored'))
+        with open('data/restored', 'rb') as f:
+            self.assertEqual(f.read(), SEGMENTS[0].encode('utf-8') * 1000)
+
+    def test_pending_bytes(self):
+        with open('data/pg/pg_xlog/00000002.history', 'w') as f:
+            f.write('1\t0/3000000\tno recovery target specified\n')
+        open(os.path.join(self.status_dir, '00000002.history.ready'), 'w').close()
+        self.assertEqual(self.archiver.status()['pending_bytes'], 3 * 16 * 1024 * 1024 + 41)
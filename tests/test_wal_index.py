@@ -0,0 +1,92 @@
+import gzip
+import os
+import shutil
+import unittest
+
+from helpers.wal_index import INDEX_FILE, WalIndex
+
+FILES = ['000000010000000000000001.gz', '000000010000000000000002.gz', '000000010000000000000002.00000028.backup.gz',
+         '000000010000000000000003.gz', '000000010000000000000004.gz', '000000010000000000000004.00000060.backup.gz',
+         '000000010000000000000005.gz', '00000002.history.gz', '000000020000000000000005.gz']
+
+
+def write_backup(path, label):
+    with gzip.open(path, 'wb') as f:
+        f.write('START WAL LOCATION: 0/2000028\nLABEL: {}\n'.format(label).encode('utf-8'))
+
+
+class TestWalIndex(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestWalIndex, self).__init__(method_name)
+
+    def set_up(self):
+        self.archive_dir = 'data/wal_archive'
+        os.makedirs(self.archive_dir)
+        for name in FILES:
+            if '.backup' in name:
+                write_backup(os.path.join(self.archive_dir, name), 'nightly')
+            else:
+                open(os.path.join(self.archive_dir, name), 'w').close()
+        self.index = WalIndex(self.archive_dir)
+
+    def tear_down(self):
+        shutil.rmtree('data')
+
+    def test_cleanup(self):
+        self.assertEqual(self.index.cleanup(2), 1)
+        self.assertNotIn(FILES[0], os.listdir(self.archive_dir))
+        # the slowest slot still needs the second segment
+        self.assertEqual(self.index.cleanup(1, 0x2000000), 0)
+        self.assertEqual(self.index.cleanup(1), 3)
+        self.assertEqual(sorted(os.listdir(self.archive_dir)), sorted(FILES[4:] + [INDEX_FILE]))
+
+    def test_append_during_cleanup(self):
+        unlink = os.unlink
+
+        def append_and_unlink(path):
+            # would deadlock if the lock was held while the files are removed
+            self.index.append(['000000010000000000000006.gz'])
+            unlink(path)
+        os.unlink = append_and_unlink
+        try:
+            self.assertEqual(self.index.cleanup(1), 4)
+        finally:
+            os.unlink = unlink
+        self.assertIn('000000010000000000000006.gz', self.index.load()[1])
+        self.assertNotIn(FILES[0], self.index.load()[1])
+
+    def test_incremental(self):
+        self.index.load()
+        # not listed again, files written by others are only found by the next scan
+        os.unlink(os.path.join(self.archive_dir, FILES[1]))
+        open(os.path.join(self.archive_dir, '000000010000000000000000.gz'), 'w').close()
+        self.index.append(['000000010000000000000006.gz'])
+        names = self.index.load()[1]
+        self.assertIn(FILES[1], names)
+        self.assertIn('000000010000000000000006.gz', names)
+        self.assertNotIn('000000010000000000000000.gz', names)
+        self.assertEqual(self.index.cleanup(1), 4)
+        self.index.rescan_interval = 0
+        self.assertIn('000000010000000000000000.gz', self.index.load()[1])
+
+    def test_no_backup(self):
+        os.unlink(os.path.join(self.archive_dir, FILES[2]))
+        os.unlink(os.path.join(self.archive_dir, FILES[5]))
+        self.assertEqual(self.index.cleanup(1, 0x5000000), 0)
+
+    def test_governor_backups(self):
+        # clones and resyncs are no base backups, an unreadable history file proves nothing either
+        write_backup(os.path.join(self.archive_dir, FILES[5]), 'governor clone')
+        open(os.path.join(self.archive_dir, '000000010000000000000005.00000028.backup.gz'), 'w').close()
+        self.assertEqual(self.index.cleanup(1), 1)
+        self.assertIn(FILES[2], os.listdir(self.archive_dir))
+
+    def test_timelines(self):
+        # the backup on the later timeline is the newest one, although the old master got further on its timeline
+        write_backup(os.path.join(self.archive_dir, '000000020000000000000003.00000028.backup.gz'), 'nightly')
+        self.index.rescan_interval = 0
+        self.assertEqual(self.index.cleanup(1), 3)
+        self.assertIn(FILES[3], os.listdir(self.archive_dir))
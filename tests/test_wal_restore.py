@@ -0,0 +1,89 @@
+import os
+import shutil
+import subprocess
+import sys
+import unittest
+
+from helpers.wal_restore import WAL_SEGMENT_SIZE, WalRestore, archive_dir_fetch, main, wal_e_fetch
+
+SEGMENTS = ['0000000100000000000000FE', '0000000100000000000000FF', '000000010000000100000000',
+            '000000010000000100000001']
+
+
+class TestWalRestore(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestWalRestore, self).__init__(method_name)
+
+    def set_up(self):
+        # a local directory is standing in for the object store
+        self.archive = 'data/archive'
+        os.makedirs(self.archive)
+        for name in SEGMENTS:
+            with open(os.path.join(self.archive, name), 'w') as f:
+                f.write(name)
+        self.fetched = []
+        fetch = archive_dir_fetch(self.archive)
+
+        def counting_fetch(name, path):
+            self.fetched.append(name)
+            return fetch(name, path)
+        self.restore = WalRestore(counting_fetch, 'data/spool', 2, 2 * WAL_SEGMENT_SIZE)
+
+    def tear_down(self):
+        shutil.rmtree('data')
+
+    def test_restore(self):
+        self.assertTrue(self.restore.restore(SEGMENTS[0], 'data/wal'))
+        self.assertEqual(sorted(self.fetched), SEGMENTS[:3])
+        self.assertEqual(sorted(os.listdir('data/spool')), SEGMENTS[1:3])
+        self.fetched = []
+        self.assertTrue(self.restore.restore(SEGMENTS[1], 'data/wal'))
+        with open('data/wal') as f:
+            self.assertEqual(f.read(), SEGMENTS[1])
+        self.assertEqual(self.fetched, [])
+        # the older segment was replayed already, only the end of the archive is missing
+        self.fetched = []
+        self.assertTrue(self.restore.restore(SEGMENTS[3], 'data/wal'))
+        self.assertEqual(sorted(self.fetched), [SEGMENTS[3], '000000010000000100000002', '000000010000000100000003'])
+        self.assertEqual(os.listdir('data/spool'), ['missing'])
+        # nothing is prefetched while the standby polls for the next segment
+        self.fetched = []
+        self.assertFalse(self.restore.restore('000000010000000100000002', 'data/wal'))
+        self.assertFalse(self.restore.restore('000000010000000100000002', 'data/wal'))
+        self.assertEqual(self.fetched, ['000000010000000100000002'] * 2)
+        # a history file doesn't make postgres skip segments
+        with open(os.path.join('data/spool', SEGMENTS[2]), 'w') as f:
+            f.write(SEGMENTS[2])
+        self.assertFalse(self.restore.restore('00000002.history', 'data/wal'))
+        self.assertEqual(sorted(os.listdir('data/spool')), [SEGMENTS[2], 'missing'])
+        # the segment arrived in the archive, prefetching resumes
+        os.rename(os.path.join('data/spool', SEGMENTS[2]), os.path.join(self.archive, '000000010000000100000002'))
+        self.fetched = []
+        self.assertTrue(self.restore.restore('000000010000000100000002', 'data/wal'))
+        self.assertEqual(self.fetched, ['000000010000000100000002'])
+        self.assertEqual(os.listdir('data/spool'), [])
+
+    def test_max_spool_size(self):
+        self.restore.max_spool_size = WAL_SEGMENT_SIZE - 1
+        self.assertTrue(self.restore.restore(SEGMENTS[0], 'data/wal'))
+        self.assertEqual(os.listdir('data/spool'), [])
+
+    def test_wal_e_fetch(self):
+        call = subprocess.call
+        subprocess.call = lambda *args, **kwargs: 1
+        try:
+            self.assertFalse(wal_e_fetch('data/env')(SEGMENTS[0], 'data/wal'))
+        finally:
+            subprocess.call = call
+
+    def test_main(self):
+        argv = sys.argv
+        sys.argv = ['wal_restore.py', '--archive-dir', self.archive, '--spool-dir', 'data/spool',
+                    SEGMENTS[0], 'data/wal']
+        try:
+            self.assertEqual(main(), 0)
+        finally:
+            sys.argv = argv
@@ -0,0 +1,40 @@
+import subprocess
+import unittest
+
+from helpers.wale import BackupCatalog
+
+
+def check_output(*args, **kwargs):
+    return b"""name last_modified expanded_size_bytes wal_segment_backup_start wal_segment_offset_backup_start \
+wal_segment_backup_stop wal_segment_offset_backup_stop
+base_00000001000000000000007F_00000040 2015-05-18T10:13:25.000Z 20310671 00000001000000000000007F 00000040 \
+00000001000000000000007F 00000240"""
+
+
+def called_process_error(*args, **kwargs):
+    raise subprocess.CalledProcessError(1, 'wal-e')
+
+
+class TestBackupCatalog(unittest.TestCase):
+
+    def __init__(self, method_name='runTest'):
+        self.setUp = self.set_up
+        self.tearDown = self.tear_down
+        super(TestBackupCatalog, self).__init__(method_name)
+
+    def set_up(self):
+        self.check_output = subprocess.check_output
+        subprocess.check_output = check_output
+        self.catalog = BackupCatalog('wal-e')
+
+    def tear_down(self):
+        subprocess.check_output = self.check_output
+
+    def test_latest(self):
+        self.assertEqual(self.catalog.latest()['expanded_size_bytes'], 20310671)
+        # cached, wal-e is not called again
+        subprocess.check_output = called_process_error
+        self.assertEqual(self.catalog.latest()['expanded_size_bytes'], 20310671)
+        self.catalog.expires = 0
+        self.assertIsNone(self.catalog.latest())
+        self.assertEqual(self.catalog.expires, 0)